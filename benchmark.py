@@ -0,0 +1,341 @@
+"""
+Benchmark for sf2-to-sfz.py.
+
+Generates a synthetic SF2 file of configurable size and times the conversion stages separately:
+parsing the SF2, formatting the instrument zones into SFZ opcodes, writing the SFZ files and
+exporting the samples as WAV files, plus a full conversion, also with several worker processes
+to show how it scales with the number of cores. With --sf3 the samples are stored as Ogg Vorbis,
+as in an SF3 file, so the export and conversions include decoding them (this needs soundfile).
+Results can be saved as a baseline and later runs compared against it. Everything runs offline,
+in a temporary folder.
+
+Usage:
+  python benchmark.py [--presets N] [--instruments N] [--zones N] [--samples N] [--sample-length FRAMES]
+                      [--shared-ratio RATIO] [--sf3] [--jobs N,N,...] [--repeat N] [--json FILE]
+                      [--save-baseline FILE] [--baseline FILE]
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+
+def load_converter():
+    """
+    Imports sf2-to-sfz.py, whose file name isn't a valid module name, from the folder of this script.
+    It is registered in sys.modules, so --jobs worker processes can unpickle its worker functions.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sf2-to-sfz.py")
+    spec = importlib.util.spec_from_file_location("sf2_to_sfz", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+converter = load_converter()
+gen_map = converter.gen_map
+
+def riff_chunk(chunk_id, data):
+    pad = b"\0" if len(data) % 2 else b""
+    return chunk_id + struct.pack("<I", len(data)) + data + pad
+
+def list_chunk(list_type, chunks):
+    return riff_chunk(b"LIST", list_type + b"".join(chunks))
+
+def name20(name):
+    return name.encode("latin-1")[:19].ljust(20, b"\0")
+
+def records(fmt, rows):
+    return b"".join(struct.pack(fmt, *row) for row in rows)
+
+def make_synthetic_sf2(path, presets=64, instruments=32, zones=8, samples=128, sample_length=44100,
+                       shared_ratio=0.5, seed=1, sf3=False):
+    """
+    Writes a synthetic SF2 file to path and returns the number of instrument zones its presets play.
+
+    Every preset references one to four instruments, and every instrument has a global zone plus
+    `zones` zones spread over the keyboard. A shared_ratio fraction of the zones play one of a small
+    set of samples shared by all instruments (a tenth of the samples), the other zones go through
+    the remaining samples in turn. Samples are looped 16 bit mono noise at 44.1 kHz; with sf3, they are
+    stored as Ogg Vorbis streams as in an SF3 file.
+    """
+    rnd = random.Random(seed)
+
+    smpl = bytearray()
+    shdr = []
+    for idx in range(samples):
+        pcm = rnd.randbytes(sample_length * 2)
+        if sf3:
+            # SF3 headers hold the byte range of the stream in smpl, and loop points relative to the sample.
+            start = len(smpl)
+            smpl += encode_ogg_vorbis(pcm)
+            shdr.append((name20(f"Sample {idx}"), start, len(smpl), sample_length // 4, sample_length - sample_length // 4,
+                         44100, 60, 0, 0, 1 | converter.SF3_COMPRESSED))
+            continue
+        start = len(smpl) // 2
+        # Every sample is followed by 46 zero frames, as the SF2 specification requires.
+        smpl += pcm + bytes(92)
+        end = start + sample_length
+        shdr.append((name20(f"Sample {idx}"), start, end, start + sample_length // 4, end - sample_length // 4,
+                     44100, 60, 0, 0, 1))
+    shdr.append((name20("EOS"), 0, 0, 0, 0, 0, 0, 0, 0, 0))
+
+    shared_count = max(1, samples // 10)
+    unique_samples = list(range(shared_count, samples)) or list(range(samples))
+    next_unique = 0
+    inst, ibag, igen = [], [], []
+    for i in range(instruments):
+        inst.append((name20(f"Instrument {i}"), len(ibag)))
+        ibag.append((len(igen), 0))
+        igen.append((gen_map["OPER_ATTACK_VOL_ENV"], rnd.randint(-7000, -2000) & 0xffff))
+        igen.append((gen_map["OPER_RELEASE_VOL_ENV"], rnd.randint(-3000, 1000) & 0xffff))
+        for z in range(zones):
+            low = z * 128 // zones
+            high = (z + 1) * 128 // zones - 1
+            if rnd.random() < shared_ratio:
+                sample_id = rnd.randrange(shared_count)
+            else:
+                sample_id = unique_samples[next_unique % len(unique_samples)]
+                next_unique += 1
+            ibag.append((len(igen), 0))
+            igen.append((gen_map["OPER_KEY_RANGE"], low | (high << 8)))
+            igen.append((gen_map["OPER_VEL_RANGE"], 127 << 8))
+            igen.append((gen_map["OPER_INITIAL_FILTER_CUTOFF"], rnd.randint(5000, 13500)))
+            igen.append((gen_map["OPER_DECAY_VOL_ENV"], rnd.randint(-2000, 2000) & 0xffff))
+            igen.append((gen_map["OPER_SUSTAIN_VOL_ENV"], rnd.randint(0, 400)))
+            igen.append((gen_map["OPER_FREQ_MOD_LFO"], rnd.randint(-2000, 500) & 0xffff))
+            igen.append((gen_map["OPER_PAN"], rnd.randint(-500, 500) & 0xffff))
+            igen.append((gen_map["OPER_SAMPLE_MODES"], 1))
+            igen.append((gen_map["OPER_OVERRIDING_ROOT_KEY"], (low + high) // 2))
+            igen.append((gen_map["OPER_SAMPLE_ID"], sample_id))
+    inst.append((name20("EOI"), len(ibag)))
+    ibag.append((len(igen), 0))
+    igen.append((0, 0))
+
+    played_zones = 0
+    phdr, pbag, pgen = [], [], []
+    for p in range(presets):
+        phdr.append((name20(f"Preset {p}"), p % 128, p // 128, len(pbag), 0, 0, 0))
+        pbag.append((len(pgen), 0))
+        pgen.append((gen_map["OPER_REVERB_EFFECTS_SEND"], rnd.randint(0, 500)))
+        for i in rnd.sample(range(instruments), min(instruments, rnd.randint(1, 4))):
+            pbag.append((len(pgen), 0))
+            pgen.append((gen_map["OPER_KEY_RANGE"], 127 << 8))
+            pgen.append((gen_map["OPER_INSTRUMENT"], i))
+            played_zones += zones
+    phdr.append((name20("EOP"), 0, 0, len(pbag), 0, 0, 0))
+    pbag.append((len(pgen), 0))
+    pgen.append((0, 0))
+
+    info = list_chunk(b"INFO", [riff_chunk(b"ifil", struct.pack("<HH", 3 if sf3 else 2, 1)), riff_chunk(b"isng", b"EMU8000\0"),
+                                riff_chunk(b"INAM", b"Synthetic benchmark\0")])
+    sdta = list_chunk(b"sdta", [riff_chunk(b"smpl", bytes(smpl))])
+    pdta = list_chunk(b"pdta", [
+        riff_chunk(b"phdr", records("<20sHHHIII", phdr)), riff_chunk(b"pbag", records("<HH", pbag)),
+        riff_chunk(b"pmod", bytes(10)), riff_chunk(b"pgen", records("<HH", pgen)),
+        riff_chunk(b"inst", records("<20sH", inst)), riff_chunk(b"ibag", records("<HH", ibag)),
+        riff_chunk(b"imod", bytes(10)), riff_chunk(b"igen", records("<HH", igen)),
+        riff_chunk(b"shdr", records("<20sIIIIIBbHH", shdr)),
+    ])
+    body = b"sfbk" + info + sdta + pdta
+    with open(path, "wb") as f:
+        f.write(b"RIFF" + struct.pack("<I", len(body)) + body)
+    return played_zones
+
+def encode_ogg_vorbis(pcm):
+    """
+    Encodes 16 bit little endian mono frames at 44.1 kHz as an Ogg Vorbis stream.
+    """
+    if converter.soundfile is None:
+        raise RuntimeError("--sf3 needs the soundfile package (python -m pip install soundfile)")
+    ogg = io.BytesIO()
+    with converter.soundfile.SoundFile(ogg, 'w', 44100, 1, format='OGG', subtype='VORBIS') as f:
+        f.buffer_write(pcm, dtype='int16')
+    return ogg.getvalue()
+
+def best_time(func, repeat):
+    """
+    Runs func repeat times and returns the shortest wall time in seconds, with the result of the last run.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def preset_regions(sf2):
+    """
+    Returns (preset, [(instrument index, bag, sample)]) for every preset of sf2.
+    """
+    result = []
+    for preset in sf2.presets:
+        if preset.name == "EOP":
+            continue
+        regions = []
+        for group, instrument in enumerate(preset.instruments):
+            if not hasattr(instrument, "bags"):
+                continue
+            for bag, sample, _ in converter.instrument_sample_regions(instrument):
+                regions.append((group, bag, sample))
+        result.append((preset, regions))
+    return result
+
+def run_benchmark(sf2_path, work_dir, zones, repeat, jobs=(1,)):
+    """
+    Times the conversion stages of the SF2 at sf2_path, writing into work_dir. The full conversion is
+    timed once per number of worker processes in jobs, as stage "total" for 1 and "total-jN" for N.
+    Returns {stage: {"seconds": ..., throughput: ...}}.
+    """
+    mb = 1024 * 1024
+    file_size = os.path.getsize(sf2_path)
+    stages = {}
+
+    def parse():
+        with open(sf2_path, "rb") as f:
+            sf2 = converter.load_sf2(f)
+            for preset in sf2.presets:
+                for instrument in preset.instruments:
+                    getattr(instrument, "bags", None)
+            sf2.samples
+    seconds, _ = best_time(parse, repeat)
+    stages["parse"] = {"seconds": seconds, "mb_per_s": file_size / mb / seconds}
+
+    with open(sf2_path, "rb") as f:
+        sf2 = converter.load_sf2(f)
+        presets = preset_regions(sf2)
+
+        def format_zones():
+            for preset, regions in presets:
+                for global_bag in preset.bags:
+                    converter.bag_opcode_lines(global_bag, converter.sf2_to_sfz_map)
+                for group, bag, sample in regions:
+                    converter.region_opcode_lines(bag, sample, "sample.wav")
+        seconds, _ = best_time(format_zones, repeat)
+        stages["format"] = {"seconds": seconds, "zones_per_s": zones / seconds}
+
+        sfz_dir = os.path.join(work_dir, "sfz")
+        os.makedirs(sfz_dir, exist_ok=True)
+        output = converter.DirectoryOutput()
+
+        def write_sfz():
+            written = 0
+            for idx, (preset, regions) in enumerate(presets):
+                sfz = converter.SfzFile([preset.name.strip()])
+                sfz.control.append((("default_path", "Samples"),))
+                for global_bag in preset.bags:
+                    sfz.global_lines.extend(converter.bag_opcode_lines(global_bag, converter.sf2_to_sfz_map))
+                for group, bag, sample in regions:
+                    sfz.add_region(group, converter.region_opcode_lines(bag, sample, f"{sample.name}.wav"))
+                written += output.write_sfz(os.path.join(sfz_dir, f"{idx}.sfz"), sfz.render())
+            return written
+        seconds, written = best_time(write_sfz, repeat)
+        stages["sfz"] = {"seconds": seconds, "mb_per_s": written / mb / seconds}
+
+        wav_dir = os.path.join(work_dir, "wav")
+        os.makedirs(wav_dir, exist_ok=True)
+        samples = [sample for sample in sf2.samples if sample.name != "EOS"]
+
+        def export():
+            written = 0
+            for idx, sample in enumerate(samples):
+                written += output.write_sample(os.path.join(wav_dir, f"{idx}.wav"), sample)
+            return written
+        seconds, written = best_time(export, repeat)
+        stages["export"] = {"seconds": seconds, "mb_per_s": written / mb / seconds}
+
+    for job_count in jobs:
+        def convert():
+            with contextlib.redirect_stdout(io.StringIO()):
+                converter.convert_sf2_file(sf2_path, "bench", os.path.join(work_dir, f"convert-{job_count}"), job_count)
+        seconds, _ = best_time(convert, repeat)
+        stages["total" if job_count == 1 else f"total-j{job_count}"] = {"seconds": seconds, "zones_per_s": zones / seconds}
+    return stages
+
+def throughput(stage):
+    if "zones_per_s" in stage:
+        return f"{stage['zones_per_s']:.0f} zones/s"
+    return f"{stage['mb_per_s']:.1f} MB/s"
+
+def compare(results, baseline, tolerance):
+    """
+    Prints results next to baseline and returns the stages more than tolerance slower than the baseline.
+    """
+    if baseline.get("config") != results["config"]:
+        print("Warning: the baseline was recorded with a different configuration", file=sys.stderr)
+    regressions = []
+    print(f"{'stage':<10} {'seconds':>10} {'throughput':>18} {'baseline':>10} {'speedup':>8}")
+    for name, stage in results["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if base is None:
+            print(f"{name:<10} {stage['seconds']:>10.4f} {throughput(stage):>18}")
+            continue
+        speedup = base["seconds"] / stage["seconds"]
+        flag = ""
+        if stage["seconds"] > base["seconds"] * (1 + tolerance):
+            regressions.append(name)
+            flag = "  slower"
+        print(f"{name:<10} {stage['seconds']:>10.4f} {throughput(stage):>18} {base['seconds']:>10.4f} {speedup:>7.2f}x{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sf2-to-sfz.py on a synthetic SF2 file.")
+    parser.add_argument("--presets", type=int, default=64, help="Number of presets (default: 64).")
+    parser.add_argument("--instruments", type=int, default=32, help="Number of instruments (default: 32).")
+    parser.add_argument("--zones", type=int, default=8, help="Zones per instrument (default: 8).")
+    parser.add_argument("--samples", type=int, default=128, help="Number of samples (default: 128).")
+    parser.add_argument("--sample-length", type=int, default=44100, help="Length of every sample in frames (default: 44100).")
+    parser.add_argument("--shared-ratio", type=float, default=0.5, help="Fraction of zones playing one of the samples shared by all instruments (default: 0.5).")
+    parser.add_argument("--sf3", action="store_true", help="Store the samples as Ogg Vorbis, as in an SF3 file, so that exporting them includes decoding (needs soundfile).")
+    parser.add_argument("--jobs", default="1", metavar="N,N,...", help="Comma separated numbers of worker processes to time the full conversion with, e.g. 1,2,4 (default: 1).")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the synthetic SF2 file (default: 1).")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per stage; the fastest one is reported (default: 3).")
+    parser.add_argument("--json", metavar="FILE", help="Also write the results to this JSON file.")
+    parser.add_argument("--save-baseline", metavar="FILE", help="Save the results as a baseline to compare later runs against.")
+    parser.add_argument("--baseline", metavar="FILE", help="Compare the results against this baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="With --baseline, exit with status 1 if a stage is this fraction slower (default: 0.1).")
+    args = parser.parse_args()
+
+    config = {name: getattr(args, name) for name in
+              ("presets", "instruments", "zones", "samples", "sample_length", "shared_ratio", "seed", "sf3")}
+    jobs = [int(job_count) for job_count in args.jobs.split(",")]
+    if 1 not in jobs:
+        jobs.insert(0, 1)
+    with tempfile.TemporaryDirectory(prefix="sf2-to-sfz-benchmark-") as work_dir:
+        sf2_path = os.path.join(work_dir, "synthetic.sf2")
+        zones = make_synthetic_sf2(sf2_path, args.presets, args.instruments, args.zones, args.samples,
+                                   args.sample_length, args.shared_ratio, args.seed, args.sf3)
+        print(f"Synthetic SF2: {os.path.getsize(sf2_path) / (1024 * 1024):.1f} MB, {zones} zones played by {args.presets} presets")
+        stages = run_benchmark(sf2_path, work_dir, zones, args.repeat, jobs)
+
+    results = {"config": config, "stages": stages}
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Slower than the baseline: {', '.join(regressions)}", file=sys.stderr)
+            status = 1
+    else:
+        print(f"{'stage':<10} {'seconds':>10} {'throughput':>18}")
+        for name, stage in stages.items():
+            print(f"{name:<10} {stage['seconds']:>10.4f} {throughput(stage):>18}")
+    for job_count in jobs[1:]:
+        print(f"{job_count} workers: {stages['total']['seconds'] / stages[f'total-j{job_count}']['seconds']:.2f}x the speed of 1")
+
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=1)
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main()
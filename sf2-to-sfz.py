@@ -1,19 +1,55 @@
 #!/usr/bin/env python3
 # Author: bash explode
 import argparse
+import array
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import cProfile
+import glob
+import hashlib
+import io
+import itertools
+import json
+import locale
 import os
+import pstats
+import queue
 import re
 import wave
 import sys
+import zipfile
 import logging
 import math
+import mmap
+import multiprocessing
+import struct
+import tarfile
+import threading
+import time
+import zlib
 
 from sf2utils.sf2parse import Sf2File
 from sf2utils.generator import Sf2Gen
+from sf2utils.instrument import Sf2Instrument
+from sf2utils.preset import Sf2Preset
+from sf2utils.riffparser import RiffParser, from_cstr
+from sf2utils.sample import Sf2Sample
+
+# Optional: decodes the Ogg Vorbis samples of SF3 files.
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
 
 # Set logging level (only errors will be shown)
 logging.getLogger().setLevel(logging.ERROR)
 
+# Version of the generated output. Bump it whenever a change alters the SFZ or WAV files written
+# for the same input, so --incremental runs don't reuse output from an older converter.
+CONVERTER_VERSION = 2
+
 ### RIPPED FROM SF2UTILS AND REPURPOSED ###
 gen_map = {
     "OPER_START_ADDR_OFFSET": 0,
@@ -66,96 +102,45 @@ gen_map = {
     "OPER_OVERRIDING_ROOT_KEY": 58,
 }
 
-def return_gen_value(gen, gen_header):
-    # Create generator object from sf2utils
-    generator = Sf2Gen(gen_header)
-    
-    if gen is None:
-        gen = generator.oper
-    
-    operator_name = None
-    for op in gen_map.keys():
-        if gen == gen_map[op]:
-            operator_name = op
-            break
-
-    
-
-    #return {operator_name: Sf2Gen(gen_header).amount}
-    if operator_name == "OPER_START_ADDR_OFFSET":
-        return {operator_name: generator.short}
-    elif operator_name == "OPER_END_ADDR_OFFSET":
-        return {operator_name: generator.short}
-    elif operator_name == "OPER_START_LOOP_ADDR_OFFSET":
-        return {operator_name: generator.short}
-    elif operator_name == "OPER_END_LOOP_ADDR_OFFSET":
-        return {operator_name: generator.short}
-    elif operator_name == "OPER_START_ADDR_COARSE_OFFSET":
-        return {operator_name: generator.coarse_offset}
-    elif operator_name == "OPER_MOD_LFO_TO_PITCH":
-        return {operator_name: generator.cents}
-    elif operator_name == "OPER_VIB_LFO_TO_PITCH":
-        return {operator_name: generator.cents}
-    elif operator_name == "OPER_MOD_ENV_TO_PITCH":
-        return {operator_name: generator.cents}
-    elif operator_name == "OPER_INITIAL_FILTER_CUTOFF":
-        return {operator_name: generator.absolute_cents}
-    elif operator_name == "OPER_INITIAL_FILTER_Q":
-        return {operator_name: generator.attenuation * 10.}
-    elif operator_name == "OPER_MOD_LFO_TO_FILTER_CUTOFF":
-        return {operator_name: generator.cents}
-    elif operator_name == "OPER_MOD_ENV_TO_FILTER_CUTOFF":
-        return {operator_name: generator.cents}
-    elif operator_name == "OPER_END_ADDR_COARSE_OFFSET":
-        return {operator_name: generator.coarse_offset}
-    elif operator_name == "OPER_MOD_LFO_TO_VOLUME":
-        return {operator_name: generator.attenuation * 10.}
-    elif operator_name == "OPER_CHORUS_EFFECTS_SEND":
-        return {operator_name: generator.send_amount}
-    elif operator_name == "OPER_REVERB_EFFECTS_SEND":
-        return {operator_name: generator.send_amount}
-    elif operator_name == "OPER_PAN":
-        return {operator_name: generator.pan}
-    elif operator_name == "OPER_DELAY_MOD_LFO":
-        return {operator_name: generator.cents}
-    elif operator_name == "OPER_FREQ_MOD_LFO":
-        return {operator_name: generator.absolute_cents}
-    elif operator_name == "OPER_DELAY_VIB_LFO":
-        return {operator_name: generator.cents}
-    elif operator_name == "OPER_FREQ_VIB_LFO":
-        return {operator_name: generator.absolute_cents}
-    elif operator_name == "OPER_DELAY_MOD_ENV":
-        return {operator_name: generator.cents}
-    elif operator_name == "OPER_ATTACK_MOD_ENV":
-        return {operator_name: generator.cents}
-    elif operator_name == "OPER_HOLD_MOD_ENV":
-        return {operator_name: generator.cents}
-    elif operator_name == "OPER_DECAY_MOD_ENV":
-        return {operator_name: generator.cents}
-    elif operator_name == "OPER_SUSTAIN_MOD_ENV":
-        return {operator_name: generator.sustain_decrease}
-    elif operator_name == "OPER_RELEASE_MOD_ENV":
-        return {operator_name: generator.cents}
-    elif operator_name == "OPER_DELAY_VOL_ENV":
-        return {operator_name: generator.cents}
-    elif operator_name == "OPER_ATTACK_VOL_ENV":
-        return {operator_name: generator.cents}
-    elif operator_name == "OPER_HOLD_VOL_ENV":
-        return {operator_name: generator.cents}
-    elif operator_name == "OPER_DECAY_VOL_ENV":
-        return {operator_name: generator.cents}
-    elif operator_name == "OPER_SUSTAIN_VOL_ENV":
-        return {operator_name: generator.positive_attenuation * 10.}
-    elif operator_name == "OPER_RELEASE_VOL_ENV":
-        return {operator_name: generator.cents}
-    elif operator_name == "OPER_KEYNUM_TO_VOL_ENV_HOLD":
-        return {operator_name: generator.cents}
-    elif operator_name == "OPER_KEYNUM_TO_VOL_ENV_DECAY":
-        return {operator_name: generator.cents}
-    elif operator_name == "OPER_SCALE_TUNING":
-            return {operator_name: generator.amount}
-    else:
-        return None
+# Decoder turning an sf2utils Sf2Gen into the value of each supported generator operator.
+gen_decoders = {
+    "OPER_START_ADDR_OFFSET": lambda generator: generator.short,
+    "OPER_END_ADDR_OFFSET": lambda generator: generator.short,
+    "OPER_START_LOOP_ADDR_OFFSET": lambda generator: generator.short,
+    "OPER_END_LOOP_ADDR_OFFSET": lambda generator: generator.short,
+    "OPER_START_ADDR_COARSE_OFFSET": lambda generator: generator.coarse_offset,
+    "OPER_MOD_LFO_TO_PITCH": lambda generator: generator.cents,
+    "OPER_VIB_LFO_TO_PITCH": lambda generator: generator.cents,
+    "OPER_MOD_ENV_TO_PITCH": lambda generator: generator.cents,
+    "OPER_INITIAL_FILTER_CUTOFF": lambda generator: generator.absolute_cents,
+    "OPER_INITIAL_FILTER_Q": lambda generator: generator.attenuation * 10.,
+    "OPER_MOD_LFO_TO_FILTER_CUTOFF": lambda generator: generator.cents,
+    "OPER_MOD_ENV_TO_FILTER_CUTOFF": lambda generator: generator.cents,
+    "OPER_END_ADDR_COARSE_OFFSET": lambda generator: generator.coarse_offset,
+    "OPER_MOD_LFO_TO_VOLUME": lambda generator: generator.attenuation * 10.,
+    "OPER_CHORUS_EFFECTS_SEND": lambda generator: generator.send_amount,
+    "OPER_REVERB_EFFECTS_SEND": lambda generator: generator.send_amount,
+    "OPER_PAN": lambda generator: generator.pan,
+    "OPER_DELAY_MOD_LFO": lambda generator: generator.cents,
+    "OPER_FREQ_MOD_LFO": lambda generator: generator.absolute_cents,
+    "OPER_DELAY_VIB_LFO": lambda generator: generator.cents,
+    "OPER_FREQ_VIB_LFO": lambda generator: generator.absolute_cents,
+    "OPER_DELAY_MOD_ENV": lambda generator: generator.cents,
+    "OPER_ATTACK_MOD_ENV": lambda generator: generator.cents,
+    "OPER_HOLD_MOD_ENV": lambda generator: generator.cents,
+    "OPER_DECAY_MOD_ENV": lambda generator: generator.cents,
+    "OPER_SUSTAIN_MOD_ENV": lambda generator: generator.sustain_decrease,
+    "OPER_RELEASE_MOD_ENV": lambda generator: generator.cents,
+    "OPER_DELAY_VOL_ENV": lambda generator: generator.cents,
+    "OPER_ATTACK_VOL_ENV": lambda generator: generator.cents,
+    "OPER_HOLD_VOL_ENV": lambda generator: generator.cents,
+    "OPER_DECAY_VOL_ENV": lambda generator: generator.cents,
+    "OPER_SUSTAIN_VOL_ENV": lambda generator: generator.positive_attenuation * 10.,
+    "OPER_RELEASE_VOL_ENV": lambda generator: generator.cents,
+    "OPER_KEYNUM_TO_VOL_ENV_HOLD": lambda generator: generator.cents,
+    "OPER_KEYNUM_TO_VOL_ENV_DECAY": lambda generator: generator.cents,
+    "OPER_SCALE_TUNING": lambda generator: generator.amount,
+}
 
 ### END OF RIPPED FROM SF2UTILS AND REPURPOSED ###
 
@@ -216,53 +201,88 @@ sf2_to_sfz_map = {
 # "loop_start" equals the sample start_loop time 
 # "loop_end" equals the sample end_loop time 
 
-def format_operator_parameters(generators, mapping):
-    lines = []
-    
-    for gen in generators.keys():
-        #print(gen, generators[gen])
-        op_value_dict = return_gen_value(gen, generators[gen])
-        if op_value_dict is None:
+# Extra SFZ lines written before an SFZ tag from sf2oper_to_sfz_map.
+# Safety Exceptions
+sfz_tag_prefix_lines = {
+    "fil_veltrack": (("fil_type", "lpf_2p"),),
+}
+# SFZ tags that also receive the value of another SFZ tag from sf2oper_to_sfz_map.
+sfz_tag_aliases = {
+    # originally mapped to fillfo_delay but the SF2 value also is amplfo_delay and pitchlfo_delay for SFZ
+    "fillfo_delay": ("amplfo_delay", "pitchlfo_delay"),
+    # originally mapped to amplfo_freq but the SF2 value also is fillfo_freq for SFZ
+    "amplfo_freq": ("fillfo_freq",),
+    # originally mapped to pitcheg_attack but the SF2 value also is fileg_attack for SFZ
+    "pitcheg_attack": ("fileg_attack",),
+}
+# Conversion applied to the decoded SF2 value before it is written for an SFZ tag.
+sfz_tag_transforms = {
+    "fileg_sustain": lambda val: 100. * math.pow(10, -val / 20),
+}
+
+def build_operator_dispatch(mapping):
+    """
+    Precomputes, for a mapping of generator operator names to SFZ tags, a table from operator number to
+    (operator name, prefix opcodes, alias SFZ tags, SFZ tag, decoder, transform), so operator_opcodes needs
+    one lookup per generator.
+    """
+    dispatch = {}
+    for oper, sfz_tag in mapping.items():
+        if oper not in gen_decoders:
             continue
-        gen_op = list(op_value_dict)[0]
-        gen_val = op_value_dict[gen_op]
-        for oper, sfz_tag in mapping.items():
-            if oper == gen_op:
-                if gen_val is not None:
-                    # Safety Exceptions
-                    if sfz_tag == "fil_veltrack":
-                        lines.append("fil_type=lpf_2p")
-
-                    # originally mapped to fillfo_delay but the SF2 value also is amplfo_delay and pitchlfo_delay for SFZ  
-                    if sfz_tag == "fillfo_delay":
-                        lines.append(f"amplfo_delay={gen_val}")
-                        lines.append(f"pitchlfo_delay={gen_val}")
-                    
-                    # originally mapped to amplfo_freq but the SF2 value also is fillfo_freq for SFZ
-                    if sfz_tag == "amplfo_freq":
-                        lines.append(f"fillfo_freq={gen_val}")
-
-                    # originally mapped to pitcheg_attack but the SF2 value also is fileg_attack for SFZ
-                    if sfz_tag == "pitcheg_attack":
-                        lines.append(f"fileg_attack={gen_val}")
-
-                    if sfz_tag == "fileg_sustain":
-                        gen_val = 100. * math.pow(10, -gen_val / 20)
-                    
-                    lines.append(f"{sfz_tag}={gen_val}")
-    return lines
+        dispatch[gen_map[oper]] = (
+            oper,
+            sfz_tag_prefix_lines.get(sfz_tag, ()),
+            sfz_tag_aliases.get(sfz_tag, ()),
+            sfz_tag,
+            gen_decoders[oper],
+            sfz_tag_transforms.get(sfz_tag),
+        )
+    return dispatch
 
+sf2oper_to_sfz_dispatch = build_operator_dispatch(sf2oper_to_sfz_map)
 
-def format_bag_parameters(bag, mapping):
+def operator_opcodes(generators, mapping, decode_counts=None):
+    """
+    Returns the (SFZ tag, value) opcodes for the generators of a bag, in generator order.
+    Values are already formatted as they are written to the SFZ file. If a Counter is given as
+    decode_counts, every decoded generator is counted there by operator name.
+    """
+    if mapping is sf2oper_to_sfz_map:
+        dispatch = sf2oper_to_sfz_dispatch
+    else:
+        dispatch = build_operator_dispatch(mapping)
+
+    opcodes = []
+    for gen, generator in generators.items():
+        entry = dispatch.get(gen)
+        if entry is None:
+            continue
+        oper, prefix_opcodes, alias_tags, sfz_tag, decoder, transform = entry
+        gen_val = decoder(generator)
+        if decode_counts is not None:
+            decode_counts[oper] += 1
+        if gen_val is None:
+            continue
+        opcodes.extend(prefix_opcodes)
+        for alias_tag in alias_tags:
+            opcodes.append((alias_tag, f"{gen_val}"))
+        if transform is not None:
+            gen_val = transform(gen_val)
+        opcodes.append((sfz_tag, f"{gen_val}"))
+    return opcodes
+
+def bag_opcode_lines(bag, mapping, decode_counts=None):
     """
     Given a bag (global or instrument), iterates over the mapping dictionary.
     For each attribute in the mapping, if the bag has that attribute and its value is not None,
-    a corresponding line (or lines) is created in the form:
-    SFZ_TAG=VALUE
+    a corresponding SFZ opcode line is created. An opcode line is a tuple of (SFZ_TAG, VALUE) pairs
+    that are written on the same line, with values already formatted as strings.
 
-    For attributes mapping to a tuple (e.g., key_range), it outputs two lines.
-    
-    Returns the formatted string (with newline characters) to be written to the SFZ file.
+    For attributes mapping to a tuple (e.g., key_range), the line holds two opcodes.
+
+    The opcodes decoded from the bag's generators follow, one per line, counted into decode_counts
+    as in operator_opcodes.
     """
     
     lines = []
@@ -277,29 +297,24 @@ def format_bag_parameters(bag, mapping):
                         # Exception for drum samples
                         if attr == "key_range":
                             if val[0] == val[1]:
-                                lines.append("lochan=10 hichan=10")
-                                lines.append(f"key={val[0]}")
+                                lines.append((("lochan", "10"), ("hichan", "10")))
+                                lines.append((("key", f"{val[0]}"),))
                                 continue
-                        lines.append(f"{sfz_tag[0]}={val[0]} {sfz_tag[1]}={val[1]}")
+                        lines.append(((sfz_tag[0], f"{val[0]}"), (sfz_tag[1], f"{val[1]}")))
                 else:
                     if attr == "volume_envelope_sustain":
                         val = 100. * math.pow(10, -val / 20)
-                    lines.append(f"{sfz_tag}={val}")
+                    lines.append(((sfz_tag, f"{val}"),))
     for mod in bag.mods:
-        print(mod)
-    gen_params = format_operator_parameters(bag.gens, sf2oper_to_sfz_map)
-    if gen_params is not None:
-        lines.extend(gen_params)
-    if lines:
-        return "\n".join(lines) + "\n"
-    return ""
+        logging.debug("Unmapped modulator: %s", mod)
+    lines.extend((opcode,) for opcode in operator_opcodes(bag.gens, sf2oper_to_sfz_map, decode_counts))
+    return lines
 
-def write_parameters(f, param_str):
+def render_opcode_lines(lines):
     """
-    Writes the given parameter string (if non-empty) to the open file f.
+    Renders opcode lines as SFZ text, one "TAG=VALUE TAG=VALUE" line each.
     """
-    if param_str:
-        f.write(param_str)
+    return "".join(" ".join(f"{sfz_tag}={val}" for sfz_tag, val in line) + "\n" for line in lines)
 
 def sanitize_filename(name):
     """
@@ -308,30 +323,1785 @@ def sanitize_filename(name):
     """
     return re.sub(r'[^A-Za-z0-9_\-]', '_', name)
 
-def export_sample(sample, output_path):
+def assign_sample_filename(sample, sample_prefix, used_names, sample_format="wav"):
+    """
+    Returns the filename for a sample: "<sample_prefix>-<SanitizedSampleName>.wav", or .flac for the "flac" sample_format.
+    Uses the true sample name, sanitized, and appends a counter if the name was already used.
     """
-    Exports a given Sf2Sample to a WAV file at output_path.
+    base_name = sanitize_filename(sample.name.strip())
+    if base_name in used_names:
+        used_names[base_name] += 1
+        base_name = f"{base_name}-{used_names[base_name]}"
+    else:
+        used_names[base_name] = 1
+    return f"{sample_prefix}-{base_name}.{sample_format}"
+
+# Size of the chunks sample data is copied in when the OS can't copy it in kernel space.
+EXPORT_CHUNK_SIZE = 1 << 20
+
+def write_wav_header(f, nchannels, sampwidth, framerate, data_length):
+    """
+    Writes the 44 byte PCM WAV header for data_length bytes of sample data to the open file f,
+    exactly as the wave module does.
+    """
+    f.write(b"RIFF")
+    f.write(struct.pack("<I", 36 + data_length))
+    f.write(b"WAVEfmt ")
+    f.write(struct.pack("<IHHIIHH", 16, 1, nchannels, framerate,
+                        nchannels * framerate * sampwidth, nchannels * sampwidth, sampwidth * 8))
+    f.write(b"data")
+    f.write(struct.pack("<I", data_length))
+
+def copy_sample_data(source, offset, length, f):
+    """
+    Copies length bytes found at offset in the source file to the current position of the open file f,
+    without holding them in memory. Uses copy_file_range or sendfile where the OS supports it,
+    otherwise writes fixed-size chunks of a read-only memory map of the source.
+    """
+    f.flush()
+    src_fd = source.fileno()
+    copied = 0
+    try:
+        dst_fd = f.fileno()
+        while copied < length:
+            if hasattr(os, "copy_file_range"):
+                n = os.copy_file_range(src_fd, dst_fd, length - copied, offset + copied)
+            else:
+                n = os.sendfile(dst_fd, src_fd, offset + copied, length - copied)
+            if n == 0:
+                break
+            copied += n
+    except (AttributeError, OSError):
+        pass
+    if copied:
+        # Move the buffered file object to where the kernel copy left the descriptor.
+        f.seek(0, os.SEEK_END)
+
+    if copied < length:
+        with mmap.mmap(src_fd, 0, access=mmap.ACCESS_READ) as data:
+            view = memoryview(data)
+            try:
+                for pos in range(offset + copied, offset + length, EXPORT_CHUNK_SIZE):
+                    f.write(view[pos:min(pos + EXPORT_CHUNK_SIZE, offset + length)])
+            finally:
+                view.release()
+
+def sample_source_file(sample):
+    """
+    Returns the real file the sample's SF2 was parsed from, or None if it has no file descriptor.
+    """
+    source = getattr(sample.sf2parser, "riff_file", None)
+    try:
+        source.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+    return source
+
+def export_sample(sample, output_path, sample_format="wav"):
+    """
+    Exports a given Sf2Sample to a WAV file, or a FLAC file for the "flac" sample_format, at output_path.
+    """
+    with open(output_path, 'wb') as sample_file:
+        write_sample_file(sample, sample_file, sample_format)
+
+def write_sample_file(sample, sample_file, sample_format="wav"):
+    """
+    Writes a given Sf2Sample, or StereoSamplePair, as a WAV or FLAC file to the open binary file sample_file.
+    """
+    if sample_format == "flac":
+        wav_file = io.BytesIO()
+        write_sample_wav(sample, wav_file)
+        sample_file.write(encode_flac(wav_file.getvalue()))
+    else:
+        write_sample_wav(sample, sample_file)
+
+def sample_file_data(sample, sample_format="wav"):
+    """
+    Returns the data of the WAV or FLAC file of a given Sf2Sample, or StereoSamplePair.
+    """
+    sample_file = io.BytesIO()
+    write_sample_file(sample, sample_file, sample_format)
+    return sample_file.getvalue()
+
+def encode_flac(wav_data):
+    """
+    Encodes the WAV file held in wav_data as FLAC and returns the FLAC file's data.
+
+    The FLAC data is decoded again and its PCM frames compared with the WAV's before it is returned,
+    so a lossy encode raises a ValueError instead of being written.
+    """
+    if soundfile is None:
+        raise RuntimeError("writing FLAC files needs the soundfile package (python -m pip install soundfile)")
+    with soundfile.SoundFile(io.BytesIO(wav_data)) as wav:
+        # 24 bit frames are passed as the top bytes of 32 bit integers.
+        dtype = 'int16' if wav.subtype == 'PCM_16' else 'int32'
+        frames = bytes(wav.buffer_read(dtype=dtype))
+        flac_file = io.BytesIO()
+        with soundfile.SoundFile(flac_file, 'w', wav.samplerate, wav.channels, wav.subtype, format='FLAC') as flac:
+            flac.buffer_write(frames, dtype=dtype)
+    flac_data = flac_file.getvalue()
+
+    with soundfile.SoundFile(io.BytesIO(flac_data)) as flac:
+        if bytes(flac.buffer_read(dtype=dtype)) != frames:
+            raise ValueError("FLAC encoding did not preserve the PCM frames")
+    return flac_data
+
+def sample_data_range(sample):
+    """
+    Returns (source file, offset, length) of the data of a 16 bit Sf2Sample in its SF2 file, which is
+    copied as is into the data section of its WAV file, or None for samples that are assembled or decoded
+    instead: stereo pairs, 24 bit and SF3 samples, and samples of an SF2 without a file descriptor.
+    If the SF2 is truncated, this is reported on stderr and length cut to the data available.
+    """
+    if isinstance(sample, (StereoSamplePair, Sf3Sample)):
+        return None
+    source = sample_source_file(sample)
+    if source is None or sample.sample_width != 2 or sample.smpl_offset is None:
+        return None
+    expected_bytes = (sample.end - sample.start) * 2
+    offset = sample.smpl_offset + sample.start * 2
+    available = max(0, min(expected_bytes, os.fstat(source.fileno()).st_size - offset))
+    available -= available % 2
+    if available != expected_bytes:
+        print(f"Warning: Sample '{sample.name}' expected {expected_bytes} bytes, got {available} bytes", file=sys.stderr)
+    return source, offset, available
+
+def write_pcm_wav(wav_file, source, offset, length, framerate):
+    """
+    Writes a mono 16 bit WAV file with the length bytes found at offset in the source file as its data
+    to the open binary file wav_file. The source file is only accessed at explicit offsets, so this
+    can run in another thread than the one reading the SF2.
+    """
+    write_wav_header(wav_file, 1, 2, framerate, length)
+    copy_sample_data(source, offset, length, wav_file)
+
+def write_sample_wav(sample, wav_file):
+    """
+    Writes a given Sf2Sample, or StereoSamplePair, as a WAV file to the open binary file wav_file.
     Uses sample.start, sample.end, and sample.sample_width to compute the expected data length.
+
+    16 bit samples are streamed straight from the SF2 smpl chunk into the WAV data section,
+    so memory use stays flat regardless of the sample size. 24 bit samples are assembled from
+    the smpl and sm24 chunks one block of frames at a time. SF3 samples are decoded in memory.
     """
+    if isinstance(sample, StereoSamplePair):
+        write_stereo_wav(sample, wav_file)
+        return
+
+    if isinstance(sample, Sf3Sample):
+        data = read_sample_frames(sample)
+        expected_bytes = sample.duration * 2
+        if len(data) != expected_bytes:
+            print(f"Warning: Sample '{sample.name}' expected {expected_bytes} bytes, got {len(data)} bytes", file=sys.stderr)
+        write_wav_header(wav_file, 1, 2, sample.sample_rate, len(data))
+        wav_file.write(data)
+        return
+
+    data_range = sample_data_range(sample)
+    if data_range is not None:
+        write_pcm_wav(wav_file, *data_range, sample.sample_rate)
+        return
+
     duration = sample.end - sample.start
     expected_bytes = duration * sample.sample_width
+
+    if sample.sample_width == 3 and sample.smpl_offset is not None:
+        header_pos = wav_file.tell()
+        write_wav_header(wav_file, 1, 3, sample.sample_rate, expected_bytes)
+        written = 0
+        block_frames = EXPORT_CHUNK_SIZE // 3
+        for first in range(0, duration, block_frames):
+            count = min(block_frames, duration - first)
+            data = read_sample_frames(sample, first, count)
+            wav_file.write(data)
+            written += len(data)
+            if len(data) != count * 3:
+                break
+        if written != expected_bytes:
+            print(f"Warning: Sample '{sample.name}' expected {expected_bytes} bytes, got {written} bytes", file=sys.stderr)
+            # Fix up the data length in the header.
+            wav_file.seek(header_pos)
+            write_wav_header(wav_file, 1, 3, sample.sample_rate, written)
+            wav_file.seek(0, os.SEEK_END)
+        return
+
     raw_data = sample.raw_sample_data
 
     if len(raw_data) != expected_bytes:
         print(f"Warning: Sample '{sample.name}' expected {expected_bytes} bytes, got {len(raw_data)} bytes", file=sys.stderr)
 
-    with wave.open(output_path, 'wb') as wav_file:
+    with wave.open(wav_file, 'wb') as wav_writer:
         # Assume mono audio (adjust if stereo is needed)
-        wav_file.setnchannels(1)
-        wav_file.setsampwidth(sample.sample_width)
-        wav_file.setframerate(sample.sample_rate)
-        wav_file.writeframes(raw_data)
+        wav_writer.setnchannels(1)
+        wav_writer.setsampwidth(sample.sample_width)
+        wav_writer.setframerate(sample.sample_rate)
+        wav_writer.writeframes(raw_data)
+
+class StereoSamplePair:
+    """
+    The left and right Sf2Sample of a linked stereo pair, exported together as one interleaved
+    stereo WAV file named after the left sample. indices holds their (left, right) sample indices.
+    """
+    def __init__(self, left, right, indices):
+        self.left = left
+        self.right = right
+        self.indices = indices
+        self.name = left.name
+
+def trim_sample(sample, first, last):
+    """
+    Returns a copy of an Sf2Sample, or StereoSamplePair, reduced to its frames [first, last).
+    """
+    if isinstance(sample, StereoSamplePair):
+        return StereoSamplePair(trim_sample(sample.left, first, last), trim_sample(sample.right, first, last),
+                                sample.indices)
+    duration = sample.duration
+    trimmed = copy.copy(sample)
+    if isinstance(sample, Sf3Sample):
+        trimmed.span = (min(first, duration), min(last, duration))
+    else:
+        trimmed.start = sample.start + min(first, duration)
+        trimmed.end = sample.start + min(last, duration)
+    trimmed.start_loop = sample.start_loop - first
+    trimmed.end_loop = sample.end_loop - first
+    return trimmed
+
+def read_sample_frames(sample, first=0, count=None):
+    """
+    Returns count frames (by default all of them) of an Sf2Sample from frame first on, as little endian
+    PCM at sample.sample_width: the 16 bit words of the smpl chunk, or for 24 bit samples, the same words
+    combined with the low bytes of the sm24 chunk. Fewer frames are returned if the SF2 is truncated.
+
+    24 bit frames are packed with three strided slice assignments over the whole block instead of
+    frame by frame.
+    """
+    if count is None:
+        count = sample.duration - first
+    if isinstance(sample, Sf3Sample):
+        if sample.span is not None:
+            first += sample.span[0]
+        return decode_sf3_sample(sample)[first * 2:(first + count) * 2]
+    high = sample.sf2parser.read(count * 2, pos=sample.smpl_offset + (sample.start + first) * 2)
+    frames = len(high) // 2
+    if sample.sm24_offset is None:
+        return high[:frames * 2]
+
+    low = sample.sf2parser.read(frames, pos=sample.sm24_offset + sample.start + first)
+    frames = min(frames, len(low))
+    data = bytearray(frames * 3)
+    data[0::3] = low[:frames]
+    data[1::3] = high[0:frames * 2:2]
+    data[2::3] = high[1:frames * 2:2]
+    return data
+
+def sample_pcm_data(sample):
+    """
+    Returns the raw smpl bytes of an Sf2Sample, followed by its sm24 bytes if the SF2 has them.
+    For an Sf3Sample, these are the bytes of its Ogg Vorbis stream.
+    """
+    if isinstance(sample, Sf3Sample):
+        return sample.compressed_data()
+    data = sample.sf2parser.read(sample.duration * 2, pos=sample.smpl_offset + sample.start * 2)
+    if sample.sm24_offset is not None:
+        data += sample.sf2parser.read(sample.duration, pos=sample.sm24_offset + sample.start)
+    return data
+
+def sample_pcm_chunks(sample):
+    """
+    Yields the bytes of sample_pcm_data(sample) in chunks of at most EXPORT_CHUNK_SIZE, so that large
+    samples are never held in memory whole. SF3 samples are yielded as one chunk.
+    """
+    if isinstance(sample, Sf3Sample):
+        yield sample.compressed_data()
+        return
+    ranges = [(sample.smpl_offset + sample.start * 2, sample.duration * 2)]
+    if sample.sm24_offset is not None:
+        ranges.append((sample.sm24_offset + sample.start, sample.duration))
+    for offset, length in ranges:
+        for pos in range(offset, offset + length, EXPORT_CHUNK_SIZE):
+            yield sample.sf2parser.read(min(EXPORT_CHUNK_SIZE, offset + length - pos), pos=pos)
+
+def write_stereo_wav(pair, wav_file):
+    """
+    Writes a StereoSamplePair as a 2 channel WAV file to the open binary file wav_file.
+
+    The channels are interleaved with strided slice assignments, one per byte of a frame, rather
+    than frame by frame. If one side is shorter, it is padded with silence.
+    """
+    width = pair.left.sample_width
+    left = read_sample_frames(pair.left)
+    right = read_sample_frames(pair.right)
+    for sample, data in ((pair.left, left), (pair.right, right)):
+        expected_bytes = sample.duration * width
+        if len(data) != expected_bytes:
+            print(f"Warning: Sample '{sample.name}' expected {expected_bytes} bytes, got {len(data)} bytes", file=sys.stderr)
+
+    frame_size = 2 * width
+    interleaved = bytearray(max(len(left), len(right)) * 2)
+    for byte in range(width):
+        interleaved[byte:len(left) * 2:frame_size] = left[byte::width]
+        interleaved[width + byte:len(right) * 2:frame_size] = right[byte::width]
+
+    write_wav_header(wav_file, 2, width, pair.left.sample_rate, len(interleaved))
+    wav_file.write(interleaved)
 
-def generate_sfz_for_preset(preset, sf2, output_base, base_folder):
+# pdta sub-chunk id -> (sf2utils hydra header name, record type, record size, struct format)
+pdta_record_formats = {
+    b'phdr': ('Phdr', Sf2File.Phdr, 38, '<20sHHHIII'),
+    b'pbag': ('Pbag', Sf2File.Pbag, 4, '<HH'),
+    b'pmod': ('Pmod', Sf2File.Pmod, 10, '<HHHHH'),
+    b'pgen': ('Pgen', Sf2File.Pgen, 4, '<HH'),
+    b'inst': ('Inst', Sf2File.Inst, 22, '<20sH'),
+    b'ibag': ('Ibag', Sf2File.Ibag, 4, '<HH'),
+    b'imod': ('Imod', Sf2File.Imod, 10, '<HHHHH'),
+    b'igen': ('Igen', Sf2File.Igen, 4, '<HH'),
+    b'shdr': ('Shdr', Sf2File.Shdr, 46, '<20sIIIIIBbHH'),
+}
+
+# Sample type flag of SF3 samples stored as Ogg Vorbis streams.
+SF3_COMPRESSED = 0x10
+# Largest possible Ogg page: 27 byte header, 255 segment sizes and 255 segments of 255 bytes.
+OGG_MAX_PAGE_SIZE = 27 + 255 + 255 * 255
+
+def ogg_frame_count(data):
+    """
+    Returns the granule position of the last page found in data, the end of an Ogg Vorbis stream,
+    which is the length of the decoded stream in frames.
+    """
+    pos = len(data)
+    while pos > 0:
+        pos = data.rfind(b"OggS", 0, pos)
+        if pos < 0 or pos + 27 > len(data):
+            break
+        segments = data[pos + 26]
+        page_size = 27 + segments + sum(data[pos + 27:pos + 27 + segments])
+        if data[pos + 4] == 0 and pos + page_size == len(data):
+            return struct.unpack_from("<q", data, pos + 6)[0]
+    raise ValueError("Ogg stream has no final page")
+
+class Sf3Sample(Sf2Sample):
+    """
+    A sample of an SF3 file, stored in the smpl chunk as an Ogg Vorbis stream.
+
+    start and end are the byte offsets of the stream in the smpl chunk, and the loop points are already
+    relative to the decoded sample. duration is the decoded length in frames, read from the last Ogg page
+    without decoding, or the length of span, the (first, last) frames trim_sample restricts the sample to.
+    """
+    def __init__(self, sample_header, smpl_offset, sf2parser):
+        self.name = from_cstr(sample_header.sample_name)
+        self.smpl_offset = smpl_offset
+        self.sm24_offset = None
+        self.sf2parser = sf2parser
+        self.start = sample_header.start
+        self.end = sample_header.end
+        self.start_loop = sample_header.start_loop
+        self.end_loop = sample_header.end_loop
+        self.sample_rate = sample_header.sample_rate
+        self.original_pitch = sample_header.original_pitch
+        if self.original_pitch > 127:
+            self.original_pitch = Sf2Sample.DEFAULT_PITCH
+        self.pitch_correction = sample_header.pitch_correction
+        self.in_rom = sample_header.sample_type & 0x8000
+        self.sample_type = sample_header.sample_type & Sf2Sample.CHANNEL_MASK
+        self.sample_link = None if self.is_mono else sample_header.sample_link
+        self.span = None
+        self.frames = None
+        # Future of the decoded frames, if decode_sf3_ahead started decoding the sample in a thread pool.
+        self.decoded = None
+
+    @property
+    def duration(self):
+        if self.frames is None:
+            size = self.end - self.start
+            tail = min(size, OGG_MAX_PAGE_SIZE)
+            self.frames = ogg_frame_count(self.sf2parser.read(tail, pos=self.smpl_offset + self.end - tail))
+        if self.span is not None:
+            return self.span[1] - self.span[0]
+        return self.frames
+
+    def compressed_data(self):
+        return self.sf2parser.read(self.end - self.start, pos=self.smpl_offset + self.start)
+
+def decode_sf3_sample(sample):
+    """
+    Decodes the Ogg Vorbis stream of an Sf3Sample into 16 bit little endian frames, or returns the frames
+    decoded in the background by decode_sf3_ahead.
+    """
+    if sample.decoded is not None:
+        return sample.decoded.result()
+    return decode_ogg_vorbis(sample.compressed_data())
+
+def decode_ogg_vorbis(data):
+    """
+    Decodes the mono Ogg Vorbis stream held in data into 16 bit little endian frames. This doesn't touch
+    the SF2 file, and soundfile releases the GIL while decoding, so it can run in a thread pool.
+    """
+    if soundfile is None:
+        raise RuntimeError("decoding SF3 samples needs the soundfile package (python -m pip install soundfile)")
+    with soundfile.SoundFile(io.BytesIO(data)) as ogg:
+        if ogg.channels != 1:
+            raise ValueError(f"expected a mono Ogg Vorbis stream, got {ogg.channels} channels")
+        frames = array.array('h', bytes(ogg.buffer_read(dtype='int16')))
+    if sys.byteorder == 'big':
+        frames.byteswap()
+    return frames.tobytes()
+
+def with_decoded_sf3(sample, pool):
+    """
+    Returns a copy of an Sf2Sample, or StereoSamplePair, whose Sf3Sample parts are being decoded by pool.
+    Their compressed streams are read in the calling thread. Other samples are returned as they are.
+    """
+    if isinstance(sample, StereoSamplePair):
+        return StereoSamplePair(with_decoded_sf3(sample.left, pool), with_decoded_sf3(sample.right, pool),
+                                sample.indices)
+    if not isinstance(sample, Sf3Sample):
+        return sample
+    decoding = copy.copy(sample)
+    decoding.decoded = pool.submit(decode_ogg_vorbis, sample.compressed_data())
+    return decoding
+
+def decode_sf3_ahead(samples, pool, window):
+    """
+    Yields the samples with_decoded_sf3 returns for each of samples, in order, keeping window samples
+    ahead of the one yielded being decoded by pool. At most window + 1 decoded samples are held in memory.
+    """
+    pending = collections.deque()
+    for sample in samples:
+        pending.append(with_decoded_sf3(sample, pool))
+        if len(pending) > window:
+            yield pending.popleft()
+    yield from pending
+
+def build_sample(sample_header, smpl_offset, sm24_offset, sf2parser):
+    """
+    Builds the Sf2Sample of a sample header, or an Sf3Sample for an SF3 compressed one.
+    """
+    if sample_header.sample_type & SF3_COMPRESSED:
+        return Sf3Sample(sample_header, smpl_offset, sf2parser)
+    return Sf2Sample(sample_header, smpl_offset, sm24_offset, sf2parser)
+
+class SoundFontFile(Sf2File):
+    """
+    sf2utils' Sf2File, with samples built by build_sample so SF3 files can be read too.
+    """
+    def build_samples(self):
+        return [build_sample(sample_header, self._raw.smpl_offset, self._raw.sm24_offset, self)
+                for sample_header in self._raw.pdta['Shdr']]
+
+class LazyRecords:
+    """
+    Read-only sequence over the records of a pdta sub-chunk that decodes records from the file
+    only when they are accessed.
+    """
+    def __init__(self, parser, offset, size, record_type, record_size, record_format):
+        self.parser = parser
+        self.offset = offset
+        self.count = size // record_size
+        self.record_type = record_type
+        self.record_size = record_size
+        self.record_format = record_format
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(self.count)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            if stop <= start:
+                return []
+            data = self.parser.read((stop - start) * self.record_size, pos=self.offset + start * self.record_size)
+            return [self.record_type(*fields) for fields in struct.iter_unpack(self.record_format, data)]
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError("record index out of range")
+        data = self.parser.read(self.record_size, pos=self.offset + idx * self.record_size)
+        return self.record_type(*struct.unpack(self.record_format, data))
+
+class LazyItems:
+    """
+    Read-only sequence of sf2utils objects built on first access and then reused.
+    """
+    def __init__(self, count, build):
+        self.count = count
+        self.build = build
+        self.items = {}
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError("item index out of range")
+        if idx not in self.items:
+            self.items[idx] = self.build(idx)
+        return self.items[idx]
+
+class LazySf2File(RiffParser):
+    """
+    Drop-in replacement for sf2utils' Sf2File for converting a few presets out of a large bank.
+
+    Opening only records where the smpl, sm24 and pdta sub-chunks are in the file. Preset, instrument,
+    bag, generator and sample header records are decoded when a preset actually reaches them, and
+    presets, instruments and samples are built as the same sf2utils objects Sf2File builds.
+    """
+    def __init__(self, sf2_file):
+        super(LazySf2File, self).__init__(sf2_file)
+        self.smpl_offset = None
+        self.smpl_size = 0
+        self.sm24_offset = None
+        self.sm24_size = 0
+        self.hydra_header = {}
+        self.scan()
+
+        # An sm24 chunk too small for the smpl chunk must be ignored, as SF2.04 specifies.
+        if self.sm24_offset is not None and self.sm24_size < self.smpl_size // 2:
+            self.sm24_offset = None
+
+        for hydra_name, record_type, record_size, record_format in pdta_record_formats.values():
+            if hydra_name not in self.hydra_header:
+                raise ValueError(f"No {hydra_name.lower()} chunk in PDTA section")
+        self.presets = LazyItems(len(self.hydra_header['Phdr']),
+                                 lambda idx: Sf2Preset(self.hydra_header, idx, self))
+        self.instruments = LazyItems(len(self.hydra_header['Inst']),
+                                     lambda idx: Sf2Instrument(self.hydra_header, idx, self))
+        self.samples = LazyItems(len(self.hydra_header['Shdr']),
+                                 lambda idx: build_sample(self.hydra_header['Shdr'][idx], self.smpl_offset, self.sm24_offset, self))
+
+    def chunks(self, start, end):
+        """
+        Yields (chunk id, data offset, data size) for the chunks found between start and end.
+        """
+        pos = start
+        while pos + 8 <= end:
+            header = self.read(8, pos=pos)
+            if len(header) < 8:
+                break
+            chunk_id, size = struct.unpack('<4sI', header)
+            yield chunk_id, pos + 8, size
+            pos += 8 + size + (size & 1)
+
+    def scan(self):
+        header = self.read(12, pos=0)
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'sfbk':
+            raise ValueError("Not a SoundFont 2 file")
+        riff_end = 8 + struct.unpack('<I', header[4:8])[0]
+        for chunk_id, offset, size in self.chunks(12, riff_end):
+            if chunk_id != b'LIST':
+                continue
+            list_type = self.read(4, pos=offset)
+            for sub_id, sub_offset, sub_size in self.chunks(offset + 4, offset + size):
+                if list_type == b'sdta' and sub_id == b'smpl':
+                    self.smpl_offset = sub_offset
+                    self.smpl_size = sub_size
+                elif list_type == b'sdta' and sub_id == b'sm24':
+                    self.sm24_offset = sub_offset
+                    self.sm24_size = sub_size
+                elif list_type == b'pdta' and sub_id in pdta_record_formats:
+                    hydra_name, record_type, record_size, record_format = pdta_record_formats[sub_id]
+                    self.hydra_header[hydra_name] = LazyRecords(self, sub_offset, sub_size,
+                                                                record_type, record_size, record_format)
+
+def load_sf2(f):
+    """
+    Parses the SF2 in the open binary file f with sf2utils' Sf2File.
+
+    Sf2File only keeps the first sub-chunk of the sdta section, which drops the sm24 chunk holding
+    the low bytes of 24 bit samples, so its offset is looked up with a LazySf2File scan instead.
+    """
+    sf2 = SoundFontFile(f)
+    if sf2.raw.sm24_offset is None:
+        sf2.raw.sm24_offset = LazySf2File(f).sm24_offset
+    return sf2
+
+def preset_selector_key(selector):
+    """
+    Parses a --preset selector: "bank:program" gives a (bank, program) tuple, anything else a lowercase preset name.
+    """
+    match = re.fullmatch(r'\s*(\d+)\s*:\s*(\d+)\s*', selector)
+    if match:
+        return (int(match.group(1)), int(match.group(2)))
+    return selector.strip().lower()
+
+def select_presets(sf2, selectors):
+    """
+    Returns the indices of the presets of a LazySf2File matching any of the selectors, in file order.
+    Only the preset header records are decoded.
+    """
+    wanted = {preset_selector_key(selector): selector for selector in selectors}
+    indices = []
+    matched = set()
+    headers = sf2.hydra_header['Phdr']
+    # The last preset header is the EOP sentinel.
+    for idx, header in enumerate(headers[:len(headers) - 1]):
+        keys = {from_cstr(header.name).strip().lower(), (header.bank, header.preset)}
+        if keys & wanted.keys():
+            indices.append(idx)
+            matched |= keys
+    for key, selector in wanted.items():
+        if key not in matched:
+            print(f"Warning: no preset matches '{selector}'", file=sys.stderr)
+    return indices
+
+def stereo_partner(bags, i, used):
+    """
+    Returns the index in bags, a list of (bag, sample) of one instrument, of the bag playing the other
+    half of the stereo pair played by bags[i] over the same key and velocity range, or None.
+    Only pairs with matching sample rates are merged.
+    """
+    bag, sample = bags[i]
+    if sample.sample_type not in (Sf2Sample.CHANNEL_LEFT, Sf2Sample.CHANNEL_RIGHT):
+        return None
+    sample_idx = bag.gens[Sf2Gen.OPER_SAMPLE_ID].amount
+    for j in range(i + 1, len(bags)):
+        other_bag, other = bags[j]
+        if (j not in used
+                and other_bag.gens[Sf2Gen.OPER_SAMPLE_ID].amount == sample.sample_link
+                and other.sample_link == sample_idx
+                and other.sample_type | sample.sample_type == Sf2Sample.CHANNEL_LEFT | Sf2Sample.CHANNEL_RIGHT
+                and other.sample_rate == sample.sample_rate
+                and other_bag.key_range == bag.key_range
+                and other_bag.velocity_range == bag.velocity_range):
+            return j
+    return None
+
+def instrument_sample_regions(instrument, merge_stereo=False):
+    """
+    Returns (bag, sample, sample index) for every bag of instrument that plays a sample.
+
+    With merge_stereo, the two bags playing a linked left/right sample pair become one entry
+    for the first of them, whose sample is a StereoSamplePair and index the (left, right) pair.
+    """
+    bags = []
+    for bag in instrument.bags:
+        sample = bag.sample
+        if sample is None or sample.name == "EOS":
+            continue
+        bags.append((bag, sample))
+
+    regions = []
+    used = set()
+    for i, (bag, sample) in enumerate(bags):
+        if i in used:
+            continue
+        sample_idx = bag.gens[Sf2Gen.OPER_SAMPLE_ID].amount
+        j = stereo_partner(bags, i, used) if merge_stereo else None
+        if j is None:
+            regions.append((bag, sample, sample_idx))
+            continue
+        used.add(j)
+        other = bags[j][1]
+        other_idx = bags[j][0].gens[Sf2Gen.OPER_SAMPLE_ID].amount
+        if sample.is_left:
+            pair = StereoSamplePair(sample, other, (sample_idx, other_idx))
+        else:
+            pair = StereoSamplePair(other, sample, (other_idx, sample_idx))
+        regions.append((bag, pair, pair.indices))
+    return regions
+
+def preset_sample_regions(sf2, preset_indices, options):
+    """
+    Yields (preset, bag, sample, sample index) for every region of the given presets, in the order
+    generate_sfz_for_preset writes them.
+    """
+    for idx in preset_indices:
+        preset = sf2.presets[idx]
+        if preset.name == "EOP":
+            continue
+        for instrument in preset.instruments:
+            if not hasattr(instrument, "bags"):
+                continue
+            for bag, sample, sample_idx in instrument_sample_regions(instrument, options.merge_stereo):
+                yield preset, bag, sample, sample_idx
+
+def instrument_regions(sf2, instrument_indices, options):
+    """
+    Yields (instrument, bag, sample, sample index) for every region of the instruments at instrument_indices,
+    in the order generate_sfz_for_instrument writes them.
+    """
+    for idx in instrument_indices:
+        instrument = sf2.instruments[idx]
+        if not hasattr(instrument, "bags"):
+            continue
+        for bag, sample, sample_idx in instrument_sample_regions(instrument, options.merge_stereo):
+            yield instrument, bag, sample, sample_idx
+
+def select_instruments(sf2, preset_indices, preset_selectors=None):
+    """
+    Returns the indices of the instruments to write an SFZ for: all of them or, if preset_selectors are
+    given, those used by the selected presets at preset_indices, in file order.
+    """
+    if not preset_selectors:
+        return range(len(sf2.instruments) - 1)
+    indices = set()
+    for idx in preset_indices:
+        for bag in sf2.presets[idx].bags:
+            gen = bag.gens.get(Sf2Gen.OPER_INSTRUMENT)
+            if gen is not None:
+                indices.add(gen.word)
+    return sorted(indices)
+
+def instrument_sfz_filenames(sf2, output_base):
+    """
+    Returns the SFZ filename of every instrument of sf2, "<output_base> Instrument <name>.sfz", numbering
+    instruments that share a name. Only the instrument headers are read.
+    """
+    headers = sf2.hydra_header['Inst'] if isinstance(sf2, LazySf2File) else sf2.raw.pdta['Inst']
+    filenames = []
+    used_names = {}
+    for idx in range(len(headers) - 1):
+        name = from_cstr(headers[idx].name).strip()
+        used_names[name] = used_names.get(name, 0) + 1
+        if used_names[name] > 1:
+            name = f"{name}-{used_names[name]}"
+        filenames.append(f"{output_base} Instrument {name}.sfz")
+    return filenames
+
+def address_offset(bag, fine_oper, coarse_oper):
+    """
+    Returns the sum of a bag's fine and coarse sample address offset generators, in sample frames.
+    """
+    offset = 0
+    for oper in (fine_oper, coarse_oper):
+        gen = bag.gens.get(gen_map[oper])
+        if gen is not None:
+            offset += gen_decoders[oper](gen)
+    return offset
+
+def bag_play_range(bag, sample):
+    """
+    Returns the (start, end) frames of sample, relative to its start, that bag plays once its start and
+    end address offsets are applied, clamped to the sample.
+    """
+    duration = sample.duration
+    start = address_offset(bag, "OPER_START_ADDR_OFFSET", "OPER_START_ADDR_COARSE_OFFSET")
+    end = duration + address_offset(bag, "OPER_END_ADDR_OFFSET", "OPER_END_ADDR_COARSE_OFFSET")
+    start = min(max(start, 0), duration)
+    end = min(max(end, start), duration)
+    return start, end
+
+def add_play_range(play_ranges, key, bag, sample):
+    """
+    Widens play_ranges[key], the (first, last) span of frames exported for a sample with trim_samples,
+    to what bag plays of sample, including the loop if the bag loops.
+    """
+    first, last = bag_play_range(bag, sample)
+    if bag.sample_loop:
+        first = min(first, max(bag.cooked_loop_start, 0))
+        last = max(last, min(bag.cooked_loop_end, sample.duration))
+    if key in play_ranges:
+        first = min(first, play_ranges[key][0])
+        last = max(last, play_ranges[key][1])
+    play_ranges[key] = (first, last)
+
+def load_sample(sf2, sample_idx):
+    """
+    Returns the Sf2Sample at sample_idx, or the StereoSamplePair for a (left, right) index pair.
+    """
+    if isinstance(sample_idx, tuple):
+        return StereoSamplePair(sf2.samples[sample_idx[0]], sf2.samples[sample_idx[1]], sample_idx)
+    return sf2.samples[sample_idx]
+
+class SampleContentIndex:
+    """
+    Finds sample headers pointing at identical PCM data, such as copies of one waveform with
+    different names or loop points, so that the data is exported once.
+
+    Samples are fingerprinted with a CRC32 of their smpl/sm24 bytes, and samples with the same
+    fingerprint are compared byte for byte before being treated as one. key() returns the
+    (start, end, sample rate) of the first sample seen with the same data and sample rate.
+    Loop points, root key and tuning stay those of each header, as they are written per region.
+    hits counts the headers found to share the data of an earlier one.
+    """
+    def __init__(self):
+        # Sample keys by (start, end, sample rate) of the header.
+        self.keys = {}
+        # (fingerprint, length, sample width, sample rate) -> [(key, sample)] of the distinct data seen.
+        self.buckets = {}
+        self.hits = 0
+
+    def __getstate__(self):
+        # Sent to --jobs workers after planning: the keys are all they need.
+        return {"keys": self.keys, "buckets": {}, "hits": 0}
+
+    def key(self, sample):
+        if isinstance(sample, StereoSamplePair):
+            return (self.key(sample.left), self.key(sample.right))
+        position = (sample.start, sample.end, sample.sample_rate)
+        if position not in self.keys:
+            data = sample_pcm_data(sample)
+            bucket = self.buckets.setdefault((zlib.crc32(data), len(data), sample.sample_width, sample.sample_rate), [])
+            for key, other in bucket:
+                if sample_pcm_data(other) == data:
+                    self.hits += 1
+                    break
+            else:
+                key = position
+                bucket.append((key, sample))
+            self.keys[position] = key
+        return self.keys[position]
+
+def sample_identity(sample):
+    """
+    Returns the key of a sample within one preset's sample folder: the sample object itself.
+    """
+    if isinstance(sample, StereoSamplePair):
+        return (id(sample.left), id(sample.right))
+    return id(sample)
+
+class SharedSamplePool:
+    """
+    A sample folder shared by every preset and instrument SFZ of a conversion run:
+      "<base_folder>/<output_base> Samples"
+
+    Each SF2 sample is exported once, keyed by its (start, end) range in the smpl chunk and its sample rate,
+    so presets that reuse the same sample data all point at the same WAV file.
+    With a SampleContentIndex, samples are keyed by their data instead.
+    """
+    def __init__(self, base_folder, output_base, content_index=None):
+        self.output_base = output_base
+        self.folder = os.path.join(base_folder, f"{output_base} Samples")
+        # Exported sample filenames keyed by smpl range and sample rate, and used base names for uniqueness.
+        self.sample_files = {}
+        self.used_names = {}
+        self.content_index = content_index
+        # Exported (first, last) frame spans keyed like sample_files, with trim_samples.
+        self.play_ranges = {}
+
+    def key(self, sample):
+        if self.content_index is not None:
+            return self.content_index.key(sample)
+        if isinstance(sample, StereoSamplePair):
+            return (self.key(sample.left), self.key(sample.right))
+        # Headers sharing a range at different sample rates need their own WAV, which carries the rate.
+        return (sample.start, sample.end, sample.sample_rate)
+
+    def plan(self, sf2, preset_indices, options, instrument_indices=()):
+        """
+        Assigns filenames to every sample referenced by the given presets, then the given instruments,
+        in the same order generate_sfz_for_preset and generate_sfz_for_instrument would, without
+        exporting anything.
+
+        Returns a list of (sample index, key, sample filename, preset or instrument name) still to be
+        exported, where merged stereo pairs have a (left, right) sample index.
+        """
+        pending = []
+        for owner, bag, sample, sample_idx in itertools.chain(preset_sample_regions(sf2, preset_indices, options),
+                                                              instrument_regions(sf2, instrument_indices, options)):
+            key = self.key(sample)
+            if key not in self.sample_files:
+                sample_filename = assign_sample_filename(sample, self.output_base, self.used_names, options.sample_format)
+                self.sample_files[key] = sample_filename
+                pending.append((sample_idx, key, sample_filename, owner.name))
+        return pending
+
+    def collect_play_ranges(self, sf2, preset_indices, options, instrument_indices=()):
+        """
+        Works out the span of every sample the given presets and instruments play, for trim_samples, before
+        any sample is exported: a sample shared by several presets must cover all of their zones.
+        """
+        for owner, bag, sample, sample_idx in itertools.chain(preset_sample_regions(sf2, preset_indices, options),
+                                                              instrument_regions(sf2, instrument_indices, options)):
+            add_play_range(self.play_ranges, self.key(sample), bag, bag.sample)
+
+def bag_records(hydra_header, bag, gen_name, mod_name):
+    """
+    Returns the raw generator and modulator records of a bag, as parsed from the pdta chunk.
+    """
+    return (hydra_header[gen_name][bag.gen_idx:bag.gen_idx + bag.gen_size],
+            hydra_header[mod_name][bag.mod_idx:bag.mod_idx + bag.mod_size])
+
+class ConversionCache:
+    """
+    Manifest of a previous conversion, stored in the base folder, used by --incremental to skip
+    presets whose SFZ is still valid and samples whose WAV is already on disk.
+
+    Samples are keyed on a digest of their header and smpl/sm24 byte range. Presets are keyed on a
+    digest of their preset and instrument zone records, the samples and sample filenames they
+    reference and the conversion settings. A manifest written by another CONVERTER_VERSION is ignored.
+    """
+    FILENAME = ".sf2-to-sfz-manifest.json"
+
+    def __init__(self, base_folder, settings):
+        self.base_folder = base_folder
+        self.settings = json.dumps(settings, sort_keys=True)
+        self.manifest_path = os.path.join(base_folder, self.FILENAME)
+        # Manifest entries keyed by path relative to the base folder.
+        self.presets = {}
+        self.samples = {}
+        # Entries recorded since the last drain_updates(), for --jobs workers.
+        self.updated_presets = {}
+        self.updated_samples = {}
+        # Sample digests computed during this run, keyed by sample id.
+        self.sample_digests = {}
+
+    def load(self):
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return
+        if manifest.get("version") != CONVERTER_VERSION:
+            return
+        self.presets = manifest.get("presets", {})
+        self.samples = manifest.get("samples", {})
+
+    def save(self):
+        manifest = {"version": CONVERTER_VERSION, "presets": self.presets, "samples": self.samples}
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def relpath(self, path):
+        return os.path.relpath(path, self.base_folder)
+
+    def sample_digest(self, sample, span=None):
+        if span is not None:
+            return f"{self.sample_digest(sample)}[{span[0]}:{span[1]}]"
+        if isinstance(sample, StereoSamplePair):
+            h = hashlib.blake2b(digest_size=16)
+            h.update(f"stereo {self.sample_digest(sample.left)} {self.sample_digest(sample.right)}".encode())
+            return h.hexdigest()
+        key = id(sample)
+        if key not in self.sample_digests:
+            h = hashlib.blake2b(digest_size=16)
+            h.update(repr((sample.name, sample.start, sample.end, sample.start_loop, sample.end_loop,
+                           sample.sample_rate, sample.original_pitch, sample.pitch_correction,
+                           sample.sample_type, sample.sample_link, sample.sample_width)).encode())
+            for chunk in sample_pcm_chunks(sample):
+                h.update(chunk)
+            self.sample_digests[key] = h.hexdigest()
+        return self.sample_digests[key]
+
+    def preset_digest(self, preset, regions, sample_files, play_ranges=None, includes=None):
+        """
+        regions is the list of Regions written for the preset, sample_files maps their key to filename
+        and play_ranges, with trim_samples, key to the exported span. includes are the instrument SFZ
+        files the preset includes instead of its regions, with include_instruments.
+        """
+        h = hashlib.blake2b(digest_size=16)
+        h.update(self.settings.encode())
+        h.update(repr((preset.name, preset.bank, preset.preset)).encode())
+        for bag in preset.bags:
+            h.update(repr(bag_records(preset.hydra_header, bag, 'Pgen', 'Pmod')).encode())
+        self.update_regions_digest(h, preset.hydra_header, regions, sample_files, play_ranges)
+        if includes is not None:
+            h.update(repr(includes).encode())
+        return h.hexdigest()
+
+    def instrument_digest(self, instrument, regions, sample_files, play_ranges=None):
+        """
+        Like preset_digest, for the SFZ of an instrument.
+        """
+        h = hashlib.blake2b(digest_size=16)
+        h.update(self.settings.encode())
+        h.update(repr(("instrument", instrument.name)).encode())
+        for bag in instrument.bags:
+            h.update(repr(bag_records(instrument.hydra_header, bag, 'Igen', 'Imod')).encode())
+        self.update_regions_digest(h, instrument.hydra_header, regions, sample_files, play_ranges)
+        return h.hexdigest()
+
+    def update_regions_digest(self, h, hydra_header, regions, sample_files, play_ranges):
+        for region in regions:
+            h.update(repr(region.group).encode())
+            h.update(repr(bag_records(hydra_header, region.bag, 'Igen', 'Imod')).encode())
+            h.update(sample_files[region.key].encode())
+            h.update(self.sample_digest(region.sample).encode())
+            if play_ranges is not None:
+                h.update(repr(play_ranges.get(region.key)).encode())
+
+    def sample_is_current(self, sample_path, digest):
+        return self.samples.get(self.relpath(sample_path)) == digest and os.path.exists(sample_path)
+
+    def record_sample(self, sample_path, digest):
+        rel = self.relpath(sample_path)
+        self.samples[rel] = digest
+        self.updated_samples[rel] = digest
+
+    def preset_is_current(self, sfz_filename, digest):
+        entry = self.presets.get(self.relpath(sfz_filename))
+        if entry is None or entry["digest"] != digest or not os.path.exists(sfz_filename):
+            return False
+        return all(os.path.exists(os.path.join(self.base_folder, path)) for path in entry["samples"])
+
+    def record_preset(self, sfz_filename, digest, sample_paths):
+        rel = self.relpath(sfz_filename)
+        entry = {"digest": digest, "samples": sorted(set(self.relpath(path) for path in sample_paths))}
+        self.presets[rel] = entry
+        self.updated_presets[rel] = entry
+
+    def drain_updates(self):
+        updates = (self.updated_presets, self.updated_samples)
+        self.updated_presets = {}
+        self.updated_samples = {}
+        return updates
+
+    def merge(self, updates):
+        presets, samples = updates
+        self.presets.update(presets)
+        self.samples.update(samples)
+
+# Number of slowest SFZ files and samples listed by --stats.
+STATS_TOP = 10
+
+class ConversionStats:
+    """
+    Counters and timings of a conversion run, reported in the batch mode summary and by --stats.
+    presets and presets_skipped count the SFZ files of presets written and found up to date,
+    instruments and instruments_skipped those of instruments.
+
+    Times are in seconds: parse_time covers reading the SF2, format_time collecting the regions of the
+    presets and instruments and building their SFZ text, sample_export_time and sfz_write_time writing the
+    files. preset_times holds (SFZ file, format time) of the `top` slowest SFZ files and sample_exports
+    (sample file, time, bytes) of the `top` slowest samples; with top 0 they are not collected, so that
+    batch summaries of large libraries don't grow with every file written. generators_decoded counts the
+    generators decoded while formatting, by operator name, and dedup_hits the sample headers exported as
+    the data of another one (--dedup-samples).
+    """
+    def __init__(self, top=0):
+        self.top = top
+        self.presets = 0
+        self.presets_skipped = 0
+        self.instruments = 0
+        self.instruments_skipped = 0
+        self.samples = 0
+        self.bytes_written = 0
+        self.region_cache_hits = 0
+        self.region_cache_misses = 0
+        self.dedup_hits = 0
+        self.generators_decoded = collections.Counter()
+        self.parse_time = 0.
+        self.format_time = 0.
+        self.sample_export_time = 0.
+        self.sfz_write_time = 0.
+        self.preset_times = []
+        self.sample_exports = []
+
+    def fields(self):
+        """
+        Returns the counters and timings as a dict, as written to the batch mode summary and by --stats-json.
+        """
+        fields = dict(vars(self))
+        del fields["top"]
+        return fields
+
+    def add_preset_time(self, sfz_filename, seconds):
+        self.add_slowest(self.preset_times, (sfz_filename, seconds))
+
+    def add_sample_export(self, sample_path, seconds, size):
+        self.add_slowest(self.sample_exports, (sample_path, seconds, size))
+
+    def add_slowest(self, entries, entry):
+        if self.top:
+            entries.append(entry)
+            if len(entries) > self.top:
+                entries.remove(min(entries, key=lambda entry: entry[1]))
+
+    def merge(self, other):
+        """
+        Adds the counters of other, a ConversionStats or a dict such as a batch mode summary entry, to these.
+        Of their slowest SFZ files and samples, the `top` slowest are kept.
+        """
+        values = other if isinstance(other, dict) else other.fields()
+        for name, value in self.fields().items():
+            setattr(self, name, value + values[name])
+        self.preset_times = sorted(self.preset_times, key=lambda entry: entry[1], reverse=True)[:self.top]
+        self.sample_exports = sorted(self.sample_exports, key=lambda entry: entry[1], reverse=True)[:self.top]
+
+def format_stats(stats, top=STATS_TOP):
+    """
+    Returns the --stats summary table of a ConversionStats, listing the `top` slowest presets and samples.
+    """
+    mb = 1024 * 1024
+    lines = [f"{'Stage':<20}{'Seconds':>10}"]
+    for stage, seconds in (("parse", stats.parse_time), ("format", stats.format_time),
+                           ("sample export", stats.sample_export_time), ("SFZ write", stats.sfz_write_time)):
+        lines.append(f"{stage:<20}{seconds:>10.3f}")
+    lines.append("")
+    lines.append(f"{'Presets converted':<20}{stats.presets:>10} ({stats.presets_skipped} up to date)")
+    if stats.instruments or stats.instruments_skipped:
+        lines.append(f"{'Instruments written':<20}{stats.instruments:>10} ({stats.instruments_skipped} up to date)")
+    lines.append(f"{'Samples exported':<20}{stats.samples:>10} ({stats.bytes_written / mb:.1f} MB written in total)")
+    lines.append(f"{'Region cache':<20}{stats.region_cache_hits:>10} hits, {stats.region_cache_misses} misses")
+    lines.append(f"{'Dedup hits':<20}{stats.dedup_hits:>10}")
+    lines.append(f"{'Generators decoded':<20}{sum(stats.generators_decoded.values()):>10}")
+    for operator_name, count in stats.generators_decoded.most_common():
+        lines.append(f"  {operator_name:<34}{count:>10}")
+    if stats.preset_times:
+        lines.append("")
+        lines.append("Slowest SFZ files to format:")
+        for sfz_filename, seconds in sorted(stats.preset_times, key=lambda entry: entry[1], reverse=True)[:top]:
+            lines.append(f"  {seconds:>8.4f}  {sfz_filename}")
+    if stats.sample_exports:
+        lines.append("")
+        lines.append("Slowest samples to export:")
+        for sample_path, seconds, size in sorted(stats.sample_exports, key=lambda entry: entry[1], reverse=True)[:top]:
+            lines.append(f"  {seconds:>8.4f}  {size / mb:>7.2f} MB  {sample_path}")
+    return "\n".join(lines)
+
+def report_stats(stats, table=True, json_path=None):
+    """
+    Prints the --stats table of a ConversionStats and, if json_path is given, writes its fields there as JSON.
+    """
+    if table:
+        print(format_stats(stats))
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(stats.fields(), f, indent=1)
+
+def completed_write(write, *args):
+    """
+    Calls write(*args) and returns a Future already resolved with (bytes written, seconds taken), or with
+    the exception the write raised.
+    """
+    future = concurrent.futures.Future()
+    start = time.perf_counter()
+    try:
+        written = write(*args)
+    except Exception as e:
+        future.set_exception(e)
+    else:
+        future.set_result((written, time.perf_counter() - start))
+    return future
+
+class Output:
+    """
+    Base of the outputs converted files are written to. The converter submits files through submit_sfz
+    and submit_sample, which return a Future of (bytes written, seconds taken), and passes a callback to
+    when_written to act on writes once they are done. Here files are written synchronously by write_sfz and
+    write_sample, so the Futures are already resolved and callbacks run immediately.
+    """
+    def submit_sfz(self, path, text):
+        return completed_write(self.write_sfz, path, text)
+
+    def submit_sample(self, path, sample, sample_format="wav"):
+        return completed_write(self.write_sample, path, sample, sample_format)
+
+    def when_written(self, futures, callback):
+        callback()
+
+    def close(self):
+        pass
+
+class DirectoryOutput(Output):
+    """
+    Writes the converted SFZ and WAV files to the filesystem.
+    """
+    def makedirs(self, folder):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def write_sfz(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+        return os.path.getsize(path)
+
+    def write_sample(self, path, sample, sample_format="wav"):
+        export_sample(sample, path, sample_format)
+        return os.path.getsize(path)
+
+class MemoryOutput(Output):
+    """
+    Collects the converted files in memory as (path, data) artifacts instead of writing them to disk.
+    SFZ files are encoded as UTF-8 and paths always use "/" as separator.
+    """
+    def __init__(self):
+        self.artifacts = []
+
+    def makedirs(self, folder):
+        pass
+
+    def write_sfz(self, path, text):
+        data = text.encode("utf-8")
+        self.artifacts.append((path.replace(os.sep, "/"), data))
+        return len(data)
+
+    def write_sample(self, path, sample, sample_format="wav"):
+        data = sample_file_data(sample, sample_format)
+        self.artifacts.append((path.replace(os.sep, "/"), data))
+        return len(data)
+
+    def drain(self):
+        artifacts = self.artifacts
+        self.artifacts = []
+        return artifacts
+
+directory_output = DirectoryOutput()
+
+# Number of files, and bytes of rendered data, a PipelinedOutput holds in its queue before the converter
+# waits for the writers.
+WRITE_QUEUE_SIZE = 32
+WRITE_QUEUE_BYTES = 64 * 1024 * 1024
+
+class PipelinedOutput(DirectoryOutput):
+    """
+    Writes the converted SFZ and WAV files to the filesystem from a pool of writer threads, so that reading
+    and formatting the next samples and presets overlaps with writing the previous ones. This helps most
+    where write latency dominates, e.g. on network-mounted output folders.
+
+    The open SF2 file object can't be shared between threads, so whatever reads it is done in the calling
+    thread, and the rest is queued as a write job. 16 bit samples are queued as the offset and length of
+    their data, which the writer thread copies from the SF2 file at explicit offsets; other samples and
+    SFZ files are rendered first. For the "flac" sample_format, the writer threads encode the WAV data.
+    The queue holds at most queue_size jobs and queue_bytes of rendered data, which caps the memory used
+    by pending writes; a larger file waits until the queue is empty. The Future of each job is resolved by
+    the writer thread; callbacks passed to when_written run in the calling thread, in submission order,
+    once all their writes are done, and may submit further files. close() runs the remaining callbacks
+    and waits until every queued file is written.
+    """
+    def __init__(self, threads, queue_size=WRITE_QUEUE_SIZE, queue_bytes=WRITE_QUEUE_BYTES):
+        self.jobs = queue.Queue(queue_size)
+        self.queue_bytes = queue_bytes
+        # Bytes held by the queued jobs, guarded by the condition the calling thread waits on for space.
+        self.queued_bytes = 0
+        self.space = threading.Condition()
+        self.callbacks = collections.deque()
+        self.running_callbacks = False
+        self.threads = [threading.Thread(target=self.writer, daemon=True) for _ in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def writer(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            size = self.run_job(*job)
+            # The job's data is released by now.
+            job = None
+            with self.space:
+                self.queued_bytes -= size
+                self.space.notify()
+
+    def run_job(self, future, path, write, size, render_time):
+        start = time.perf_counter()
+        try:
+            with open(path, 'wb') as f:
+                write(f)
+                written = f.tell()
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result((written, render_time + time.perf_counter() - start))
+        return size
+
+    def submit(self, path, render):
+        """
+        Queues a write job for path. render() is called in this thread and returns (write, size), where
+        write(f) is called by a writer thread with path open for writing and size is the number of bytes
+        the job holds in memory until then.
+        """
+        future = concurrent.futures.Future()
+        start = time.perf_counter()
+        try:
+            write, size = render()
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            render_time = time.perf_counter() - start
+            with self.space:
+                while self.queued_bytes and self.queued_bytes + size > self.queue_bytes:
+                    self.space.wait()
+                self.queued_bytes += size
+            self.jobs.put((future, path, write, size, render_time))
+        self.run_callbacks()
+        return future
+
+    def submit_sfz(self, path, text):
+        def render():
+            # Encoded as open(path, 'w') would write it.
+            data = text.replace("\n", os.linesep).encode(locale.getpreferredencoding(False))
+            return (lambda f: f.write(data)), len(data)
+        return self.submit(path, render)
+
+    def submit_sample(self, path, sample, sample_format="wav"):
+        def render():
+            data_range = sample_data_range(sample)
+            if data_range is not None:
+                size = 0
+                write_wav = lambda f: write_pcm_wav(f, *data_range, sample.sample_rate)
+            else:
+                data = sample_file_data(sample)
+                size = len(data)
+                write_wav = lambda f: f.write(data)
+            if sample_format != "flac":
+                return write_wav, size
+
+            def write_flac(f):
+                wav_file = io.BytesIO()
+                write_wav(wav_file)
+                f.write(encode_flac(wav_file.getvalue()))
+            return write_flac, size
+        return self.submit(path, render)
+
+    def when_written(self, futures, callback):
+        self.callbacks.append((futures, callback))
+        self.run_callbacks()
+
+    def run_callbacks(self):
+        # Callbacks submitting files get here again; the outer loop runs the next ones, keeping their order.
+        if self.running_callbacks:
+            return
+        self.running_callbacks = True
+        try:
+            while self.callbacks and all(future.done() for future in self.callbacks[0][0]):
+                futures, callback = self.callbacks.popleft()
+                callback()
+        finally:
+            self.running_callbacks = False
+
+    def close(self):
+        # Callbacks may submit more files, so the writers are stopped only once none are left.
+        while self.callbacks:
+            concurrent.futures.wait(self.callbacks[0][0])
+            self.run_callbacks()
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+
+def open_output(writer_threads):
+    """
+    Returns the output converted files are written to: a PipelinedOutput with writer_threads threads, or
+    directory_output, writing synchronously, if writer_threads is 0.
+    """
+    return PipelinedOutput(writer_threads) if writer_threads > 0 else directory_output
+
+class ConversionOptions:
+    """
+    Options changing the SFZ and sample files written for every preset of a conversion.
+    """
+    def __init__(self, group_opcodes=False, merge_stereo=False, dedup_samples=False, trim_samples=False, sample_format="wav",
+                 export="presets", include_instruments=False):
+        # Factor the opcodes shared by all regions of an instrument into a <group> header.
+        self.group_opcodes = group_opcodes
+        # Export linked left/right sample pairs as one stereo WAV played by a single region.
+        self.merge_stereo = merge_stereo
+        # Export sample headers with identical PCM data as one WAV file.
+        self.dedup_samples = dedup_samples
+        # Export only the part of each sample its zones play, and rebase offset, end and loop points.
+        self.trim_samples = trim_samples
+        # File format of the exported samples: "wav", or "flac" (needs soundfile).
+        self.sample_format = sample_format
+        # Write the regions of every instrument once, in its own SFZ, and #include it from the presets.
+        self.include_instruments = include_instruments
+        # SFZ files to write: one per "presets", one per "instruments", or "both". Including instruments needs them written.
+        self.export = "both" if include_instruments and export == "presets" else export
+
+    @property
+    def export_presets(self):
+        return self.export != "instruments"
+
+    @property
+    def export_instruments(self):
+        return self.export != "presets"
+
+    def sample_pool(self, base_folder, output_base, sf2, preset_indices, instrument_indices=()):
+        """
+        Returns the SharedSamplePool used by --shared-samples with these options, to convert the presets
+        of sf2 at preset_indices and the instruments at instrument_indices.
+        """
+        content_index = SampleContentIndex() if self.dedup_samples else None
+        pool = SharedSamplePool(base_folder, output_base, content_index)
+        if self.trim_samples:
+            pool.collect_play_ranges(sf2, preset_indices, self, instrument_indices)
+        return pool
+
+default_options = ConversionOptions()
+
+class SfzFile:
+    """
+    Structured model of one SFZ file, rendered into a single string.
+
+    The control and global sections and every region hold opcode lines (see bag_opcode_lines).
+    Regions are added with a group key, e.g. the instrument they come from. When rendered with
+    group_opcodes, each run of consecutive regions with the same group key gets a <group> header
+    holding the opcodes all of its regions share, which are then left out of the regions.
+    includes are SFZ files #included after the global section, before the regions.
+    """
+    def __init__(self, comments):
+        self.comments = comments
+        self.control = []
+        self.global_lines = []
+        self.includes = []
+        self.regions = []
+
+    def add_region(self, group, lines):
+        self.regions.append((group, lines))
+
+    def grouped_regions(self):
+        """
+        Yields (shared opcodes, region opcode lines) for each run of regions with the same group key.
+        """
+        for _, run in itertools.groupby(self.regions, key=lambda region: region[0]):
+            region_lines = [lines for _, lines in run]
+            if len(region_lines) < 2:
+                yield [], region_lines
+                continue
+            common = set.intersection(*(set(opcode for line in lines for opcode in line) for lines in region_lines))
+            shared = []
+            for line in region_lines[0]:
+                for opcode in line:
+                    if opcode in common and opcode not in shared:
+                        shared.append(opcode)
+            region_lines = [[kept for kept in (tuple(opcode for opcode in line if opcode not in common) for line in lines) if kept]
+                            for lines in region_lines]
+            yield shared, region_lines
+
+    def render(self, group_opcodes=False):
+        parts = [f"// {comment}\n" for comment in self.comments]
+        parts.append("\n<control>\n")
+        parts.append(render_opcode_lines(self.control))
+        parts.append("\n")
+        if self.global_lines:
+            parts.append("<global>\n")
+            parts.append(render_opcode_lines(self.global_lines))
+        parts.append("\n")
+        for include in self.includes:
+            parts.append(f'#include "{include}"\n')
+
+        if group_opcodes:
+            groups = self.grouped_regions()
+        else:
+            groups = [(None, [lines for _, lines in self.regions])]
+        for shared, region_lines in groups:
+            if shared is not None:
+                # Always open a new group, so opcodes of the previous group don't carry over.
+                parts.append("<group>\n")
+                parts.append(render_opcode_lines((opcode,) for opcode in shared))
+                parts.append("\n")
+            for lines in region_lines:
+                parts.append("<region>\n")
+                parts.append(render_opcode_lines(lines))
+                parts.append("\n")
+        return "".join(parts)
+
+def region_opcode_lines(bag, sample, sample_filename):
+    """
+    Returns the opcode lines of the region for an instrument bag playing sample, exported as sample_filename.
+    """
+    lines = [(("sample", sample_filename),)]
+    lines.extend(zone_opcode_lines(bag, sample))
+    return lines
+
+def zone_opcode_lines(bag, sample, span=None, decode_counts=None):
+    """
+    Returns the opcode lines of the region for an instrument bag playing sample, except the sample opcode.
+    If the sample is exported trimmed to the (first, last) frames span, the region's offset, end and
+    loop points are rebased onto it. Decoded generators are counted into decode_counts, if given.
+    """
+    lines = bag_opcode_lines(bag, sf2_to_sfz_map, decode_counts)
+    # Determine tuning from bag, if available.
+    tune = None
+    finetune = None
+    transpose = None
+    if (hasattr(bag, "tuning") and bag.tuning is not None):
+        tune = bag.tuning * 100 
+        # weird edge case with library, I don't think anyone wants to go that many semi-tones
+        if tune >= 100 or tune <= -100:
+            tune = 0
+    else:
+        tune = 0
+    if (hasattr(bag, "fine_tuning") and bag.fine_tuning is not None):
+        finetune = bag.fine_tuning
+    else:
+        finetune = 0
+    tune = tune + finetune
+    if tune == 0:
+        tune = None
+    # Determine pitch_keycenter: use bag.base_note if available; else sample.original_pitch.
+    pk = None
+    if hasattr(bag, "base_note") and bag.base_note is not None:
+        pk = bag.base_note
+    elif hasattr(sample, "original_pitch"):
+        pk = sample.original_pitch
+        
+    # Write the pitch_keycenter (and tune if available) on one line.
+    if pk is not None:
+        if transpose is not None:
+            lines.append((("pitch_keycenter", f"{pk}"),))
+            lines.append((("transpose", f"{transpose}"),))
+        elif tune is not None:
+            lines.append((("pitch_keycenter", f"{pk}"), ("tune", f"{tune}")))
+        else:
+            lines.append((("pitch_keycenter", f"{pk}"),))
+    
+    # Play only the part of the trimmed sample the bag's address offsets select.
+    first = 0
+    if span is not None:
+        first = span[0]
+        start, end = bag_play_range(bag, sample)
+        trim_line = []
+        if start > first:
+            trim_line.append(("offset", f"{start - first}"))
+        if end < span[1]:
+            trim_line.append(("end", f"{end - first - 1}"))
+        if trim_line:
+            lines.append(tuple(trim_line))
+
+    # Add loop parameters if the sample is meant to loop.
+    if hasattr(bag, "sample_loop") and bag.sample_loop:
+        if hasattr(bag, "sample_loop_on_noteoff") and bag.sample_loop_on_noteoff:
+            loop_mode = "loop_sustain"
+        else:
+            loop_mode = "loop_continuous"
+        lines.append((("loop_mode", loop_mode),))
+        lines.append((("loop_start", f"{bag.cooked_loop_start - first}"),))
+        #lines.append((("loop_start", f"{sample.start_loop}"),))
+        lines.append((("loop_end", f"{bag.cooked_loop_end - 1 - first}"),))
+        #lines.append((("loop_end", f"{sample.end_loop}"),))
+        #lines.append((("loop_crossfade", "0.01"),))
+    return lines
+
+# Number of instrument zones a RegionCache keeps the opcode lines of.
+REGION_CACHE_SIZE = 4096
+
+class RegionCache:
+    """
+    Per-run cache of the formatted opcode lines of instrument zones, so that an instrument referenced
+    by many presets, as in GM banks and drum kits, has its zones decoded and formatted only once.
+
+    Entries are keyed on the instrument bag (its index in the ibag chunk), whether it plays a merged
+    stereo pair and the span its sample is trimmed to, and hold every line but the sample opcode,
+    which is added per region since the sample filename differs between per-preset sample folders.
+    Past max_entries, the least recently used entry is evicted. hits and misses count the lookups.
+    """
+    def __init__(self, max_entries=REGION_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def region_lines(self, bag, sample, sample_filename, span=None, decode_counts=None):
+        """
+        Returns the opcode lines of the region for bag playing sample, exported as sample_filename
+        and, with trim_samples, trimmed to span. On a miss, decoded generators are counted into
+        decode_counts, if given.
+        """
+        stereo = isinstance(sample, StereoSamplePair)
+        key = (bag.idx, stereo, span)
+        lines = self.entries.get(key)
+        if lines is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        else:
+            self.misses += 1
+            lines = zone_opcode_lines(bag, bag.sample, span, decode_counts)
+            if stereo:
+                # The pan of each half only placed it in the stereo field, which the stereo WAV now carries.
+                lines = [kept for kept in (tuple(opcode for opcode in line if opcode[0] != "pan") for line in lines) if kept]
+            lines = tuple(lines)
+            self.entries[key] = lines
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return [(("sample", sample_filename),)] + list(lines)
+
+class Region:
+    """
+    One region of an SFZ file, the intermediate model shared by preset and instrument output: the
+    instrument zone (bag) it plays, its sample (a StereoSamplePair for merged stereo pairs), the key
+    the exported sample file is found under and the group key it is grouped by with group_opcodes.
+    Big banks have tens of thousands of regions, so it is kept small with __slots__.
+    """
+    __slots__ = ("group", "bag", "sample", "key")
+
+    def __init__(self, group, bag, sample, key):
+        self.group = group
+        self.bag = bag
+        self.sample = sample
+        self.key = key
+
+def collect_regions(instruments, sample_files, sample_key, sample_prefix, used_names, options):
+    """
+    Returns the Regions of the (group key, instrument) pairs in instruments, and the (key, sample) of each
+    sample they reference that isn't in sample_files yet. Those samples are given a filename there.
+    """
+    regions = []
+    new_samples = []
+    for group, instrument in instruments:
+        if not hasattr(instrument, "bags"):
+            continue
+        for bag, sample, _ in instrument_sample_regions(instrument, options.merge_stereo):
+            key = sample_key(sample)
+            if key not in sample_files:
+                sample_files[key] = assign_sample_filename(sample, sample_prefix, used_names, options.sample_format)
+                new_samples.append((key, sample))
+            regions.append(Region(group, bag, sample, key))
+    return regions, new_samples
+
+def export_new_samples(new_samples, sample_folder, sample_files, play_ranges, cache=None, output=directory_output,
+                       options=default_options):
+    """
+    Submits the (key, sample) pairs of new_samples to output, for export into sample_folder under their
+    filename in sample_files, skipping samples cache has up to date. Returns the submitted exports, to be
+    passed to record_exported_samples once their Futures are done.
+
+    The Ogg Vorbis streams of SF3 samples are decoded by a pool of one thread per core, a window of samples
+    ahead of the one being exported.
+    """
+    exports = []
+    for key, sample in new_samples:
+        sample_path = os.path.join(sample_folder, sample_files[key])
+        span = play_ranges.get(key) if play_ranges is not None else None
+        sample_digest = None
+        if cache is not None:
+            sample_digest = cache.sample_digest(sample, span)
+            if cache.sample_is_current(sample_path, sample_digest):
+                continue
+        exports.append((key, sample, sample_path, sample_digest, sample if span is None else trim_sample(sample, *span)))
+
+    export_samples = [export_sample for *_, export_sample in exports]
+    pool = None
+    if soundfile is not None and len(exports) > 1 and any(
+            isinstance(part, Sf3Sample) for sample in export_samples
+            for part in ((sample.left, sample.right) if isinstance(sample, StereoSamplePair) else (sample,))):
+        threads = os.cpu_count() or 1
+        pool = concurrent.futures.ThreadPoolExecutor(threads)
+        export_samples = decode_sf3_ahead(export_samples, pool, threads)
+    submitted = []
+    try:
+        for (key, sample, sample_path, sample_digest, _), export_sample in zip(exports, export_samples):
+            future = output.submit_sample(sample_path, export_sample, options.sample_format)
+            submitted.append((key, sample, sample_path, sample_digest, future))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return submitted
+
+def record_exported_samples(submitted, sample_files, owner, cache=None, stats=None):
+    """
+    Records the done exports submitted by export_new_samples in cache and stats. A sample that failed to
+    export is reported as used by owner, e.g. "preset <name>", and its filename in sample_files replaced
+    with "UNKNOWN".
+    """
+    for key, sample, sample_path, sample_digest, future in submitted:
+        try:
+            sample_bytes, export_time = future.result()
+        except Exception as e:
+            print(f"Failed to export sample for {owner} ({sample.name}): {e}", file=sys.stderr)
+            sample_files[key] = "UNKNOWN"
+            continue
+        if stats is not None:
+            stats.samples += 1
+            stats.bytes_written += sample_bytes
+            stats.sample_export_time += export_time
+            stats.add_sample_export(sample_path, export_time, sample_bytes)
+        if cache is not None:
+            cache.record_sample(sample_path, sample_digest)
+
+def add_regions(sfz, regions, sample_files, play_ranges, region_cache, stats=None):
+    """
+    Adds the opcode lines of regions to sfz, formatted through region_cache.
+    """
+    hits, misses = region_cache.hits, region_cache.misses
+    decode_counts = stats.generators_decoded if stats is not None else None
+    for region in regions:
+        span = play_ranges.get(region.key) if play_ranges is not None else None
+        sfz.add_region(region.group, region_cache.region_lines(region.bag, region.sample, sample_files[region.key], span,
+                                                               decode_counts))
+    if stats is not None:
+        stats.region_cache_hits += region_cache.hits - hits
+        stats.region_cache_misses += region_cache.misses - misses
+
+def write_sfz_file(kind, owner, sfz_filename, digest, regions, new_samples, sample_folder, sample_files, play_ranges, start,
+                   cache=None, stats=None, output=directory_output, options=default_options, region_cache=None,
+                   verbose=True, global_bags=(), includes=None):
+    """
+    Writes the SFZ of owner, a preset or instrument as named by kind, once its regions are collected (see
+    generate_sfz_for_preset and generate_sfz_for_instrument). The SFZ is skipped if cache has it up to date
+    under digest. Otherwise the new_samples it is the first to reference are exported into sample_folder, and
+    the SFZ, with the opcode lines of global_bags in its global section and then either the includes or its
+    regions, is rendered and submitted to output once they are written, so that failed samples can be
+    replaced with "UNKNOWN" without waiting here. The manifest entry and stats are recorded once the SFZ
+    is written, unless it references a failed sample.
+
+    start is when formatting the SFZ began. Returns False if the SFZ was up to date.
+    """
+    if cache is not None and cache.preset_is_current(sfz_filename, digest):
+        if stats is not None:
+            if kind == "preset":
+                stats.presets_skipped += 1
+            else:
+                stats.instruments_skipped += 1
+        if verbose:
+            print(f"SFZ file up to date: {sfz_filename}")
+        return False
+    format_time = time.perf_counter() - start
+
+    submitted = export_new_samples(new_samples, sample_folder, sample_files, play_ranges, cache, output, options)
+
+    def samples_written():
+        record_exported_samples(submitted, sample_files, f"{kind} {owner.name}", cache, stats)
+        # Samples shared with an earlier SFZ may have failed there, after digest was computed.
+        export_failed = any(sample_files[region.key] == "UNKNOWN" for region in regions)
+
+        # Build the SFZ from its regions and write it in one go.
+        start = time.perf_counter()
+        sfz = SfzFile([owner.name.strip(), "Converted from SF2 to SFZ by bash explode"])
+        sfz.control.append((("default_path", os.path.basename(sample_folder)),))
+        decode_counts = stats.generators_decoded if stats is not None else None
+        for global_bag in global_bags:
+            sfz.global_lines.extend(bag_opcode_lines(global_bag, sf2_to_sfz_map, decode_counts))
+        if includes is not None:
+            sfz.includes.extend(includes)
+        else:
+            add_regions(sfz, regions, sample_files, play_ranges, region_cache or RegionCache(), stats)
+        sfz_text = sfz.render(options.group_opcodes)
+        sfz_format_time = format_time + time.perf_counter() - start
+        sample_paths = [os.path.join(sample_folder, sample_files[region.key]) for region in regions]
+        future = output.submit_sfz(sfz_filename, sfz_text)
+
+        def sfz_written():
+            try:
+                sfz_bytes, write_time = future.result()
+            except Exception as e:
+                print(f"Failed to write SFZ file for {kind} {owner.name}: {e}", file=sys.stderr)
+                return
+            if cache is not None and not export_failed:
+                cache.record_preset(sfz_filename, digest, sample_paths)
+            if stats is not None:
+                if kind == "preset":
+                    stats.presets += 1
+                else:
+                    stats.instruments += 1
+                stats.bytes_written += sfz_bytes
+                stats.format_time += sfz_format_time
+                stats.sfz_write_time += write_time
+                stats.add_preset_time(sfz_filename, sfz_format_time)
+            if verbose:
+                print(f"SFZ file generated: {sfz_filename}")
+        output.when_written([future], sfz_written)
+
+    output.when_written([future for *_, future in submitted], samples_written)
+    return True
+
+def generate_sfz_for_preset(preset, sf2, output_base, base_folder, shared_pool=None, cache=None, stats=None,
+                            output=directory_output, options=default_options, region_cache=None, instrument_files=None,
+                            verbose=True):
     """
     For a given preset, this function creates:
       - A sample folder: "<base_folder>/<output_base> <PresetName> Samples"
       - An SFZ file: "<base_folder>/<output_base> <PresetName>.sfz"
+
+    If a SharedSamplePool is given, no per-preset sample folder is created; samples are
+    exported once into the pool's folder and default_path points there instead.
+
+    If a ConversionCache is given, the preset is skipped when its SFZ and samples are still up to date,
+    and samples whose WAV is already on disk are not exported again.
+
+    If a ConversionStats is given, the written presets, samples and bytes are added to it, along with
+    the time spent formatting the preset, exporting each sample and writing the SFZ.
+
+    Files are written through output, a DirectoryOutput by default or a MemoryOutput to keep them in memory.
+    options is the ConversionOptions of the run. Passing the run's RegionCache as region_cache lets
+    presets sharing instruments reuse their formatted zones. With include_instruments, the SFZ includes
+    the instrument SFZ files, named by instrument index in instrument_files, instead of their regions.
+    Unless verbose is False, a line is printed for every SFZ file written or found up to date.
     
     It exports all samples used by the preset using their true (sanitized) names (ensuring uniqueness)
     and writes the SFZ regions including key, velocity ranges, and pitch information.
@@ -349,131 +2119,488 @@ def generate_sfz_for_preset(preset, sf2, output_base, base_folder):
     # Skip the sentinel preset.
     if preset.name == "EOP":
         return
+    start = time.perf_counter()
 
     # Prepare preset name variants.
     preset_name_clean = preset.name.strip()
     preset_name_nospace = preset_name_clean.replace(" ", "")
 
-    # Create the samples folder for this preset inside the base folder.
-    sample_folder = os.path.join(base_folder, f"{output_base} {preset_name_clean} Samples")
-    if not os.path.exists(sample_folder):
-        os.makedirs(sample_folder)
-    # Define the SFZ filename for this preset.
-    sfz_filename = os.path.join(base_folder, f"{output_base} {preset_name_clean}.sfz")
-
-    with open(sfz_filename, 'w') as f:
-        # Write header comments and control tag with default sample folder.
-        f.write("// " + preset_name_clean + "\n")
-        f.write("// Converted from SF2 to SFZ by bash explode\n\n")
-        f.write("<control>\n")
-        f.write(f"default_path={os.path.basename(sample_folder)}\n\n")
-        
-        # If the preset has a global bag, extract envelope parameters.
-        #print(preset.bags)
-        if preset.bags:
-            global_params = ""
-            for global_bag in preset.bags:
-                global_results = format_bag_parameters(global_bag, sf2_to_sfz_map)
-                if global_results:
-                    global_params = global_params + global_results
-                
-            if global_params:
-                f.write("<global>\n")
-                write_parameters(f, global_params)
-        f.write("\n")
-        
-        # Dictionary for deduplicating sample filenames (keyed by sample id)
+    if shared_pool is not None:
+        sample_folder = shared_pool.folder
+        sample_prefix = shared_pool.output_base
+        # Dictionary for deduplicating sample filenames across all presets
+        preset_sample_files = shared_pool.sample_files
+        # Track used base names for uniqueness.
+        used_names = shared_pool.used_names
+        sample_key = shared_pool.key
+    else:
+        # Create the samples folder for this preset inside the base folder.
+        sample_folder = os.path.join(base_folder, f"{output_base} {preset_name_clean} Samples")
+        sample_prefix = f"{output_base}-{preset_name_nospace}"
+        # Dictionary for deduplicating sample filenames (keyed by sample id, or sample data with dedup_samples)
         preset_sample_files = {}
         # Track used base names for uniqueness.
         used_names = {}
-        
-        # Iterate over instruments referenced by the preset.
-        for instrument in preset.instruments:
-            if not hasattr(instrument, "bags"):
-                continue
-            for bag in instrument.bags:
-                sample = bag.sample
-                
-                if sample is None or sample.name == "EOS":
-                    continue
-
-                key = id(sample)
-                if key not in preset_sample_files:
-                    # Use the true sample name, sanitized.
-                    base_name = sanitize_filename(sample.name.strip())
-                    if base_name in used_names:
-                        used_names[base_name] += 1
-                        base_name = f"{base_name}-{used_names[base_name]}"
-                    else:
-                        used_names[base_name] = 1
-                    sample_filename = f"{output_base}-{preset_name_nospace}-{base_name}.wav"
-                    sample_path = os.path.join(sample_folder, sample_filename)
-                    try:
-                        export_sample(sample, sample_path)
-                    except Exception as e:
-                        print(f"Failed to export sample for preset {preset.name} ({sample.name}): {e}", file=sys.stderr)
-                        sample_filename = "UNKNOWN"
-                    preset_sample_files[key] = sample_filename
-                else:
-                    sample_filename = preset_sample_files[key]
-                # Write a region block referencing this sample.
-                f.write("<region>\n")
-                f.write(f"sample={sample_filename}\n")
-                region_preset_instrument_params = format_bag_parameters(bag, sf2_to_sfz_map)
-                write_parameters(f, region_preset_instrument_params)
-                # Determine tuning from bag, if available.
-                tune = None
-                finetune = None
-                transpose = None
-                if (hasattr(bag, "tuning") and bag.tuning is not None):
-                    tune = bag.tuning * 100 
-                    # weird edge case with library, I don't think anyone wants to go that many semi-tones
-                    if tune >= 100 or tune <= -100:
-                        tune = 0
-                else:
-                    tune = 0
-                if (hasattr(bag, "fine_tuning") and bag.fine_tuning is not None):
-                    finetune = bag.fine_tuning
+        content_index = SampleContentIndex() if options.dedup_samples else None
+        sample_key = content_index.key if content_index is not None else sample_identity
+    output.makedirs(sample_folder)
+    # Define the SFZ filename for this preset.
+    sfz_filename = os.path.join(base_folder, f"{output_base} {preset_name_clean}.sfz")
+
+    # Collect the regions of the preset and the filename of every sample they reference.
+    regions, new_samples = collect_regions(enumerate(preset.instruments), preset_sample_files, sample_key, sample_prefix,
+                                           used_names, options)
+
+    # With include_instruments, include the SFZ of every instrument with regions, once per preset zone.
+    includes = None
+    if options.include_instruments:
+        includes = []
+        for group, _ in itertools.groupby(region.group for region in regions):
+            includes.append(instrument_files[preset.bags[group].gens[Sf2Gen.OPER_INSTRUMENT].word])
+
+    # With trim_samples, work out the span of each sample the preset's zones play.
+    play_ranges = None
+    if options.trim_samples:
+        if shared_pool is not None:
+            play_ranges = shared_pool.play_ranges
+        else:
+            play_ranges = {}
+            for region in regions:
+                add_play_range(play_ranges, region.key, region.bag, region.bag.sample)
+
+    preset_digest = None
+    if cache is not None:
+        preset_digest = cache.preset_digest(preset, regions, preset_sample_files, play_ranges, includes)
+    # If the preset has a global bag, its envelope parameters go into the global section.
+    written = write_sfz_file("preset", preset, sfz_filename, preset_digest, regions, new_samples, sample_folder,
+                             preset_sample_files, play_ranges, start, cache, stats, output, options, region_cache, verbose,
+                             preset.bags, includes)
+    if written and stats is not None and shared_pool is None and content_index is not None:
+        stats.dedup_hits += content_index.hits
+
+def generate_sfz_for_instrument(instrument, sfz_filename, shared_pool, cache=None, stats=None, output=directory_output,
+                                options=default_options, region_cache=None, verbose=True):
+    """
+    Writes the SFZ of one SF2 instrument to sfz_filename, with a region per instrument zone playing a
+    sample. Samples are exported into the folder of shared_pool, a SharedSamplePool, unless a preset or
+    instrument converted before already exported them. Instruments without such zones are skipped.
+
+    cache, stats, output, options, region_cache and verbose are used as in generate_sfz_for_preset.
+    """
+    if not hasattr(instrument, "bags"):
+        return
+    start = time.perf_counter()
+    regions, new_samples = collect_regions([(0, instrument)], shared_pool.sample_files, shared_pool.key,
+                                           shared_pool.output_base, shared_pool.used_names, options)
+    if not regions:
+        return
+    output.makedirs(shared_pool.folder)
+    play_ranges = shared_pool.play_ranges if options.trim_samples else None
+
+    instrument_digest = None
+    if cache is not None:
+        instrument_digest = cache.instrument_digest(instrument, regions, shared_pool.sample_files, play_ranges)
+    write_sfz_file("instrument", instrument, sfz_filename, instrument_digest, regions, new_samples, shared_pool.folder,
+                   shared_pool.sample_files, play_ranges, start, cache, stats, output, options, region_cache, verbose)
+
+def convert_instruments(sf2, instrument_indices, output_base, base_folder, shared_pool, cache=None, stats=None,
+                        output=directory_output, options=default_options, region_cache=None):
+    """
+    Writes the SFZ of each instrument of sf2 at instrument_indices into base_folder (see generate_sfz_for_instrument).
+    """
+    if not instrument_indices:
+        return
+    filenames = instrument_sfz_filenames(sf2, output_base)
+    for idx in instrument_indices:
+        generate_sfz_for_instrument(sf2.instruments[idx], os.path.join(base_folder, filenames[idx]), shared_pool, cache,
+                                    stats, output, options, region_cache)
+
+# Per-process state for --jobs workers. Each worker opens and parses the SF2 itself,
+# so the parsed Sf2File never has to be pickled across processes.
+_worker_state = {}
+
+def _init_worker(input_path, output_base, base_folder, shared_pool, cache, lazy, options, writer_threads=0, stats_top=0):
+    f = open(input_path, "rb")
+    _worker_state["file"] = f
+    _worker_state["sf2"] = LazySf2File(f) if lazy else load_sf2(f)
+    _worker_state["output_base"] = output_base
+    _worker_state["base_folder"] = base_folder
+    _worker_state["shared_pool"] = shared_pool
+    if cache is not None:
+        # Sample digests are keyed by object id, which is meaningless in this process.
+        cache.sample_digests = {}
+    _worker_state["cache"] = cache
+    _worker_state["options"] = options
+    _worker_state["writer_threads"] = writer_threads
+    _worker_state["stats_top"] = stats_top
+    if options.include_instruments:
+        _worker_state["instrument_files"] = instrument_sfz_filenames(_worker_state["sf2"], output_base)
+    _worker_state["region_cache"] = RegionCache()
+
+def _export_sample_worker(task):
+    sample_idx, sample_path, span = task
+    sample = load_sample(_worker_state["sf2"], sample_idx)
+    cache = _worker_state["cache"]
+    if cache is not None:
+        sample_digest = cache.sample_digest(sample, span)
+        if cache.sample_is_current(sample_path, sample_digest):
+            return sample_idx, None, None, None
+    start = time.perf_counter()
+    try:
+        export_sample(sample if span is None else trim_sample(sample, *span), sample_path, _worker_state["options"].sample_format)
+    except Exception as e:
+        return sample_idx, str(e), None, None
+    export_time = time.perf_counter() - start
+    sample_bytes = os.path.getsize(sample_path)
+    stats = ConversionStats(_worker_state["stats_top"])
+    stats.samples += 1
+    stats.bytes_written += sample_bytes
+    stats.sample_export_time += export_time
+    stats.add_sample_export(sample_path, export_time, sample_bytes)
+    if cache is not None:
+        cache.record_sample(sample_path, sample_digest)
+        return sample_idx, None, cache.drain_updates(), stats
+    return sample_idx, None, None, stats
+
+def _convert_presets_worker(preset_indices):
+    sf2 = _worker_state["sf2"]
+    cache = _worker_state["cache"]
+    stats = ConversionStats(_worker_state["stats_top"])
+    output = open_output(_worker_state["writer_threads"])
+    try:
+        for idx in preset_indices:
+            generate_sfz_for_preset(sf2.presets[idx], sf2, _worker_state["output_base"],
+                                    _worker_state["base_folder"], _worker_state["shared_pool"], cache, stats, output,
+                                    _worker_state["options"], _worker_state["region_cache"], _worker_state.get("instrument_files"))
+    finally:
+        output.close()
+    return (cache.drain_updates() if cache is not None else None), stats
+
+def convert_presets_parallel(input_path, sf2, preset_indices, output_base, base_folder, shared_pool, jobs, cache=None, stats=None,
+                             options=default_options, writer_threads=0, instrument_indices=()):
+    """
+    Converts the presets of sf2 at preset_indices using a pool of `jobs` worker processes.
+    Workers parse the SF2 with the same parser class as sf2.
+
+    Presets that share an SFZ filename are converted by the same task, in file order, so the
+    output is byte-identical to the serial path. With a SharedSamplePool, sample filenames are
+    planned up front in this process, the samples are exported in parallel, and the presets are
+    converted afterwards with the pool already filled in. Manifest entries recorded by the workers
+    are merged back into cache, and their counters into stats. With writer_threads, each worker writes the
+    SFZ and WAV files of its presets through a PipelinedOutput. The samples of the instruments at
+    instrument_indices are planned and exported along with those of the presets, so that their
+    SFZ files can then be written without exporting anything.
+    """
+    lazy = isinstance(sf2, LazySf2File)
+    stats_top = stats.top if stats is not None else 0
+    preset_groups = {}
+    for idx in preset_indices:
+        preset = sf2.presets[idx]
+        if preset.name == "EOP":
+            continue
+        preset_groups.setdefault(preset.name.strip(), []).append(idx)
+
+    if shared_pool is not None:
+        pending = shared_pool.plan(sf2, preset_indices, options, instrument_indices)
+        if not os.path.exists(shared_pool.folder):
+            os.makedirs(shared_pool.folder)
+        tasks = [(sample_idx, os.path.join(shared_pool.folder, sample_filename), shared_pool.play_ranges.get(key))
+                 for sample_idx, key, sample_filename, _ in pending]
+        failed = {}
+        with multiprocessing.Pool(jobs, initializer=_init_worker,
+                                  initargs=(input_path, output_base, base_folder, None, cache, lazy, options, 0,
+                                            stats_top)) as pool:
+            for sample_idx, error, updates, sample_stats in pool.imap(_export_sample_worker, tasks):
+                failed[sample_idx] = error
+                if updates is not None:
+                    cache.merge(updates)
+                if stats is not None and sample_stats is not None:
+                    stats.merge(sample_stats)
+            pool.close()
+            pool.join()
+        for sample_idx, key, sample_filename, preset_name in pending:
+            if failed[sample_idx] is not None:
+                sample = load_sample(sf2, sample_idx)
+                print(f"Failed to export sample for preset {preset_name} ({sample.name}): {failed[sample_idx]}", file=sys.stderr)
+                shared_pool.sample_files[key] = "UNKNOWN"
+
+    with multiprocessing.Pool(jobs, initializer=_init_worker,
+                              initargs=(input_path, output_base, base_folder, shared_pool, cache, lazy, options,
+                                        writer_threads, stats_top)) as pool:
+        for updates, preset_stats in pool.imap_unordered(_convert_presets_worker, preset_groups.values()):
+            if updates is not None:
+                cache.merge(updates)
+            if stats is not None:
+                stats.merge(preset_stats)
+        pool.close()
+        pool.join()
+
+def open_sf2(f, preset_selectors=None):
+    """
+    Parses the SF2 in the open binary file f. Returns the parsed file and the indices of the presets to convert:
+    all of them, or, if preset_selectors are given, the matching ones out of a LazySf2File.
+    """
+    if preset_selectors:
+        sf2 = LazySf2File(f)
+        return sf2, select_presets(sf2, preset_selectors)
+    sf2 = load_sf2(f)
+    return sf2, range(len(sf2.presets))
+
+def convert_stream(stream, output_base, shared_samples=False, preset_selectors=None, options=default_options, stats=None):
+    """
+    Library entry point converting an SF2 held in a binary stream or bytes-like buffer without touching the filesystem.
+
+    Yields (path, data) for every converted file as soon as the preset it belongs to is done: samples as
+    complete WAV files, then the preset's SFZ as UTF-8 text. Paths are laid out as convert_sf2_file would
+    write them into the base folder "<output_base>". Non-seekable streams are read into memory first.
+    If a ConversionStats is given, the counters and timings of the conversion are added to it.
+    Instrument SFZ files, if options export them, follow the presets. Nothing is printed to stdout;
+    failed samples and unmatched preset_selectors are still reported on stderr.
+    """
+    if isinstance(stream, (bytes, bytearray, memoryview)):
+        stream = io.BytesIO(stream)
+    elif not (hasattr(stream, "seekable") and stream.seekable()):
+        stream = io.BytesIO(stream.read())
+
+    start = time.perf_counter()
+    sf2, preset_indices = open_sf2(stream, preset_selectors)
+    if stats is not None:
+        stats.parse_time += time.perf_counter() - start
+    preset_indices, instrument_indices = export_indices(sf2, preset_indices, preset_selectors, options)
+    if options.export_instruments:
+        shared_samples = True
+    shared_pool = options.sample_pool(output_base, output_base, sf2, preset_indices, instrument_indices) if shared_samples else None
+    instrument_files = instrument_sfz_filenames(sf2, output_base) if options.include_instruments else None
+    output = MemoryOutput()
+    region_cache = RegionCache()
+    for idx in preset_indices:
+        generate_sfz_for_preset(sf2.presets[idx], sf2, output_base, output_base, shared_pool, stats=stats, output=output,
+                                options=options, region_cache=region_cache, instrument_files=instrument_files, verbose=False)
+        yield from output.drain()
+    filenames = instrument_sfz_filenames(sf2, output_base) if instrument_indices else None
+    for idx in instrument_indices:
+        generate_sfz_for_instrument(sf2.instruments[idx], os.path.join(output_base, filenames[idx]), shared_pool,
+                                    stats=stats, output=output, options=options, region_cache=region_cache, verbose=False)
+        yield from output.drain()
+    add_dedup_hits(stats, shared_pool)
+
+def export_indices(sf2, preset_indices, preset_selectors, options):
+    """
+    Returns the indices of the presets and of the instruments to write an SFZ for with options, out of the
+    presets at preset_indices matching preset_selectors.
+    """
+    instrument_indices = select_instruments(sf2, preset_indices, preset_selectors) if options.export_instruments else ()
+    if not options.export_presets:
+        preset_indices = ()
+    return preset_indices, instrument_indices
+
+def add_dedup_hits(stats, shared_pool):
+    """
+    Adds the dedup hits of a SharedSamplePool's content index to stats, once the run is done.
+    """
+    if stats is not None and shared_pool is not None and shared_pool.content_index is not None:
+        stats.dedup_hits += shared_pool.content_index.hits
+
+def write_archive(artifacts, fileobj, archive_format="zip"):
+    """
+    Writes (path, data) artifacts, e.g. from convert_stream, into a "zip" or "tar" archive streamed to the
+    binary file fileobj, which doesn't need to be seekable. WAV files are stored uncompressed in zip archives.
+    """
+    if archive_format == "zip":
+        with zipfile.ZipFile(fileobj, 'w') as archive:
+            for path, data in artifacts:
+                compress_type = zipfile.ZIP_STORED if path.endswith((".wav", ".flac")) else zipfile.ZIP_DEFLATED
+                archive.writestr(path, data, compress_type=compress_type)
+    elif archive_format == "tar":
+        with tarfile.open(fileobj=fileobj, mode='w|') as archive:
+            for path, data in artifacts:
+                info = tarfile.TarInfo(path)
+                info.size = len(data)
+                info.mtime = int(time.time())
+                archive.addfile(info, io.BytesIO(data))
+    else:
+        raise ValueError(f"Unsupported archive format: {archive_format}")
+
+def convert_sf2_file(input_path, output_base, base_folder, jobs=1, shared_samples=False, incremental=False, stats=None,
+                     preset_selectors=None, options=default_options, writer_threads=0):
+    """
+    Converts every preset of the SF2 file at input_path into base_folder, creating it if needed.
+
+    If preset_selectors are given, only the matching presets are converted and the SF2 is read
+    through a LazySf2File, so nothing the selected presets don't reference is decoded.
+    If a ConversionStats is given, the counters and timings of the conversion are added to it; with
+    jobs > 1, parse_time only covers parsing in this process, not in the workers.
+    With writer_threads, files are written through a PipelinedOutput with that many writer threads.
+
+    If options export instruments, an SFZ is written for every instrument (or, with preset_selectors,
+    every instrument the selected presets use) after the presets, and all samples are exported
+    into one shared sample folder, as with shared_samples.
+    """
+    if not os.path.exists(base_folder):
+        os.makedirs(base_folder)
+
+    # Open the SF2 file explicitly and keep it open during processing.
+    f = open(input_path, "rb")
+    try:
+        start = time.perf_counter()
+        sf2, preset_indices = open_sf2(f, preset_selectors)
+        if stats is not None:
+            stats.parse_time += time.perf_counter() - start
+        preset_indices, instrument_indices = export_indices(sf2, preset_indices, preset_selectors, options)
+        if options.export_instruments:
+            shared_samples = True
+        shared_pool = options.sample_pool(base_folder, output_base, sf2, preset_indices, instrument_indices) if shared_samples else None
+        cache = None
+        if incremental:
+            settings = {"output_base": output_base, "shared_samples": shared_samples}
+            settings.update(vars(options))
+            cache = ConversionCache(base_folder, settings)
+            cache.load()
+        try:
+            region_cache = RegionCache()
+            output = open_output(writer_threads)
+            try:
+                if jobs > 1:
+                    convert_presets_parallel(input_path, sf2, preset_indices, output_base, base_folder, shared_pool, jobs, cache,
+                                             stats, options, writer_threads, instrument_indices)
                 else:
-                    finetune = 0
-                tune = tune + finetune
-                if tune == 0:
-                    tune = None
-                # Determine pitch_keycenter: use bag.base_note if available; else sample.original_pitch.
-                pk = None
-                if hasattr(bag, "base_note") and bag.base_note is not None:
-                    pk = bag.base_note
-                elif hasattr(sample, "original_pitch"):
-                    pk = sample.original_pitch
-                    
-                # Write the pitch_keycenter (and tune if available) on one line.
-                if pk is not None:
-                    if transpose is not None:
-                        f.write(f"pitch_keycenter={pk}\ntranspose={transpose}\n")
-                    elif tune is not None:
-                        f.write(f"pitch_keycenter={pk} tune={tune}\n")
-                    else:
-                        f.write(f"pitch_keycenter={pk}\n")
-                
-                # Add loop parameters if the sample is meant to loop.
-                if hasattr(bag, "sample_loop") and bag.sample_loop:
-                    if hasattr(bag, "sample_loop_on_noteoff") and bag.sample_loop_on_noteoff:
-                        loop_mode = "loop_sustain"
-                    else:
-                        loop_mode = "loop_continuous"
-                    f.write(f"loop_mode={loop_mode}\n")
-                    f.write(f"loop_start={bag.cooked_loop_start}\n")
-                    #f.write(f"loop_start={sample.start_loop}\n")
-                    f.write(f"loop_end={bag.cooked_loop_end - 1}\n")
-                    #f.write(f"loop_end={sample.end_loop}\n")
-                    #f.write("loop_crossfade=0.01\n")
-                f.write("\n")
-    print(f"SFZ file generated: {sfz_filename}")
+                    instrument_files = instrument_sfz_filenames(sf2, output_base) if options.include_instruments else None
+                    for idx in preset_indices:
+                        generate_sfz_for_preset(sf2.presets[idx], sf2, output_base, base_folder, shared_pool, cache, stats,
+                                                output, options, region_cache, instrument_files)
+                # Instrument SFZ files are written by this process; with jobs > 1, their samples are already exported.
+                convert_instruments(sf2, instrument_indices, output_base, base_folder, shared_pool, cache, stats, output,
+                                    options, region_cache)
+            finally:
+                output.close()
+        finally:
+            if cache is not None:
+                cache.save()
+        add_dedup_hits(stats, shared_pool)
+    finally:
+        f.close()
+
+def collect_sf2_files(paths, file_list=None):
+    """
+    Expands directories (searched recursively for .sf2 and .sf3 files), glob patterns and the lines of an
+    optional file list into the SF2 files to convert, without duplicates.
+    """
+    if file_list is not None:
+        with open(file_list) as f:
+            paths = list(paths) + [line.strip() for line in f if line.strip()]
+
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                found.extend(os.path.join(root, name) for name in sorted(files) if name.lower().endswith((".sf2", ".sf3")))
+        elif any(c in path for c in "*?["):
+            found.extend(sorted(glob.glob(path, recursive=True)))
+        else:
+            found.append(path)
+
+    seen = set()
+    result = []
+    for path in found:
+        key = os.path.abspath(path)
+        if key not in seen:
+            seen.add(key)
+            result.append(path)
+    return result
+
+def _convert_batch_file(task):
+    """
+    Converts one SF2 file of a batch and returns its summary entry.
+    Warnings written to stderr during the conversion are collected into the summary.
+    """
+    (input_path, output_base, base_folder, shared_samples, incremental, preset_selectors, options, writer_threads,
+     stats_top) = task
+    stats = ConversionStats(stats_top)
+    error = None
+    captured = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stderr(captured):
+        try:
+            convert_sf2_file(input_path, output_base, base_folder, 1, shared_samples, incremental, stats, preset_selectors,
+                             options, writer_threads)
+        except Exception as e:
+            error = str(e)
+    wall_time = time.perf_counter() - start
+    sys.stderr.write(captured.getvalue())
+
+    summary = {"input": input_path, "output": base_folder}
+    summary.update(stats.fields())
+    summary["wall_time"] = round(wall_time, 3)
+    summary["warnings"] = captured.getvalue().splitlines()
+    summary["error"] = error
+    return summary
+
+def convert_batch(input_paths, output_dir, jobs=1, shared_samples=False, incremental=False, preset_selectors=None,
+                  options=default_options, writer_threads=0, stats_top=0):
+    """
+    Converts several SF2 files, each into "<output_dir>/<SF2 name>", using `jobs` worker processes.
+    Files are scheduled largest first so a big file started last doesn't hold up the whole batch.
+    The summary entry of every file lists its stats_top slowest SFZ files and samples, for --stats.
+
+    Returns the summary entries of the converted files, in input order.
+    """
+    # Give every file its own base folder, even if two SF2 files have the same name.
+    tasks = []
+    used_names = {}
+    for input_path in input_paths:
+        output_base = os.path.splitext(os.path.basename(input_path))[0]
+        if output_base in used_names:
+            used_names[output_base] += 1
+            output_base = f"{output_base}-{used_names[output_base]}"
+        else:
+            used_names[output_base] = 1
+        tasks.append((input_path, output_base, os.path.join(output_dir, output_base), shared_samples, incremental,
+                      preset_selectors, options, writer_threads, stats_top))
+
+    def file_size(task):
+        try:
+            return os.path.getsize(task[0])
+        except OSError:
+            return 0
+    scheduled = sorted(tasks, key=file_size, reverse=True)
+
+    if jobs > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            summaries = list(pool.imap_unordered(_convert_batch_file, scheduled))
+            pool.close()
+            pool.join()
+    else:
+        summaries = [_convert_batch_file(task) for task in scheduled]
+
+    order = {task[0]: idx for idx, task in enumerate(tasks)}
+    summaries.sort(key=lambda summary: order[summary["input"]])
+    return summaries
 
 def main():
     parser = argparse.ArgumentParser(description="Convert an SF2 file to separate SFZ files per preset.")
-    parser.add_argument("input", help="Input SF2 file")
-    parser.add_argument("output", help="Output SFZ base file (e.g., mySound.sfz). The base name (without extension) is used for naming the base folder, sample folders, and sample files.")
+    parser.add_argument("input", nargs="?", help="Input SF2 file")
+    parser.add_argument("output", nargs="?", help="Output SFZ base file (e.g., mySound.sfz). The base name (without extension) is used for naming the base folder, sample folders, and sample files.")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes used to convert presets (or, in batch mode, SF2 files) in parallel (default: 1).")
+    parser.add_argument("--incremental", action="store_true", help=f"Keep a manifest ({ConversionCache.FILENAME}) in the base folder and skip presets and samples that are unchanged since the previous run.")
+    parser.add_argument("--shared-samples", action="store_true", help="Export each sample once into a single '<output_base> Samples' folder shared by all presets instead of one sample folder per preset.")
+    parser.add_argument("-p", "--preset", action="append", metavar="NAME|BANK:PROGRAM", help="Only convert the preset with this name or bank:program number. Can be given several times. Only the data these presets use is read from the SF2 file.")
+    parser.add_argument("--group-opcodes", action="store_true", help="Write the opcodes shared by all regions of an instrument once in a <group> header instead of in every region, for smaller SFZ files.")
+    parser.add_argument("--merge-stereo", action="store_true", help="Export linked left/right sample pairs as one stereo WAV file played by a single region instead of two panned mono regions.")
+    parser.add_argument("--dedup-samples", action="store_true", help="Export sample headers whose PCM data is identical (e.g. copies with different names or loop points) as one WAV file.")
+    parser.add_argument("--trim-samples", action="store_true", help="Export only the part of each sample its zones play (following their start/end address offsets) plus its loop, and rebase offset, end and loop points to match.")
+    parser.add_argument("--export", choices=("presets", "instruments", "both"), default="presets", help="Write one SFZ file per preset (default), per SF2 instrument ('<output_base> Instrument <name>.sfz'), or both. Exporting instruments implies --shared-samples, so every sample is exported once for presets and instruments alike.")
+    parser.add_argument("--include-instruments", action="store_true", help="Write the regions of each instrument once, in its instrument SFZ file, and have the preset SFZ files #include those instead of repeating the regions. Implies --export both.")
+    parser.add_argument("--format", choices=("wav", "flac"), default="wav", help="File format of the exported samples (default: wav). FLAC files are checked to decode back to the same PCM and need the soundfile package.")
+    parser.add_argument("--writer-threads", type=int, metavar="N", help=f"Write the SFZ and sample files from N background threads while the next presets are converted, holding at most {WRITE_QUEUE_SIZE} pending files and {WRITE_QUEUE_BYTES // (1024 * 1024)} MB of rendered data in memory (default: with --format flac, one per core shared among the -j workers; otherwise 0, write synchronously). Speeds up writing to slow or network-mounted folders.")
+    parser.add_argument("--archive", metavar="FILE", help="Write the converted files into this zip archive (or tar archive, for names ending in .tar) instead of a base folder.")
+    parser.add_argument("--batch", nargs="+", metavar="PATH", help="Batch mode: convert every SF2 file found in these files, directories (searched recursively for .sf2 and .sf3 files) or glob patterns. Each file is converted into '<output-dir>/<SF2 name>'.")
+    parser.add_argument("--file-list", metavar="FILE", help="Batch mode: also convert the SF2 files listed in FILE, one path per line.")
+    parser.add_argument("--output-dir", default=".", help="Batch mode: folder the base folders are created in (default: current folder).")
+    parser.add_argument("--summary", metavar="FILE", help="Batch mode: JSON file the per-file summary is written to (default: '<output-dir>/sf2-to-sfz-summary.json').")
+    parser.add_argument("--stats", action="store_true", help="Print a summary of the time spent parsing, formatting presets, exporting samples and writing SFZ files, with counters such as decoded generators, dedup and region cache hits, and the slowest presets and samples.")
+    parser.add_argument("--stats-json", metavar="FILE", help="Write the counters and timings of --stats to this JSON file.")
+    parser.add_argument("--profile", metavar="FILE", help="Run the conversion under cProfile, save the profile to FILE (for pstats) and print the functions with the most cumulative time. With -j, only the main process is profiled.")
     
     # If no arguments (or not enough) are given, print help and exit.
     if len(sys.argv) < 3:
@@ -481,22 +2608,72 @@ def main():
         sys.exit(1)
     
     args = parser.parse_args()
+    if args.profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(run, parser, args)
+        finally:
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(25)
+    else:
+        run(parser, args)
+
+def run(parser, args):
+    """
+    Runs the conversion requested by the parsed command line arguments.
+    """
+    options = ConversionOptions(group_opcodes=args.group_opcodes, merge_stereo=args.merge_stereo,
+                                dedup_samples=args.dedup_samples, trim_samples=args.trim_samples,
+                                sample_format=args.format, export=args.export,
+                                include_instruments=args.include_instruments)
+    if args.archive and (args.jobs > 1 or args.incremental or args.writer_threads):
+        parser.error("--archive can't be combined with -j/--jobs, --incremental or --writer-threads")
+    if args.format == "flac" and soundfile is None:
+        parser.error("--format flac needs the soundfile package (python -m pip install soundfile)")
+    if args.writer_threads is None:
+        # FLAC encoding is CPU bound, so by default the writer threads encode on the cores left to each worker.
+        flac = args.format == "flac" and not args.archive
+        args.writer_threads = max(1, (os.cpu_count() or 1) // max(1, args.jobs)) if flac else 0
+    stats = ConversionStats(STATS_TOP) if args.stats or args.stats_json else None
+
+    if args.batch or args.file_list:
+        input_paths = collect_sf2_files(args.batch or [], args.file_list)
+        summaries = convert_batch(input_paths, args.output_dir, args.jobs, args.shared_samples, args.incremental, args.preset,
+                                  options, args.writer_threads, stats.top if stats is not None else 0)
+        if stats is not None:
+            for summary in summaries:
+                stats.merge(summary)
+            report_stats(stats, args.stats, args.stats_json)
+        summary_path = args.summary or os.path.join(args.output_dir, "sf2-to-sfz-summary.json")
+        with open(summary_path, 'w') as f:
+            json.dump({"files": summaries}, f, indent=1)
+        failed = [summary for summary in summaries if summary["error"] is not None]
+        for summary in failed:
+            print(f"Failed to convert {summary['input']}: {summary['error']}", file=sys.stderr)
+        print(f"Converted {len(summaries) - len(failed)} of {len(summaries)} SF2 file(s), summary written to {summary_path}")
+        if failed:
+            sys.exit(1)
+        return
+
+    if args.input is None or args.output is None:
+        parser.print_help()
+        sys.exit(1)
 
     # Derive the output base name (without extension).
     output_base = os.path.splitext(os.path.basename(args.output))[0]
-    # Create a base folder using the output base name.
-    base_folder = output_base
-    if not os.path.exists(base_folder):
-        os.makedirs(base_folder)
 
-    # Open the SF2 file explicitly and keep it open during processing.
-    f = open(args.input, "rb")
-    try:
-        sf2 = Sf2File(f)
-        for preset in sf2.presets:
-            generate_sfz_for_preset(preset, sf2, output_base, base_folder)
-    finally:
-        f.close()
+    if args.archive:
+        archive_format = "tar" if args.archive.lower().endswith(".tar") else "zip"
+        with open(args.input, "rb") as f, open(args.archive, "wb") as archive_file:
+            write_archive(convert_stream(f, output_base, args.shared_samples, args.preset, options, stats), archive_file,
+                          archive_format)
+    else:
+        # Create a base folder using the output base name.
+        base_folder = output_base
+        convert_sf2_file(args.input, output_base, base_folder, args.jobs, args.shared_samples, args.incremental, stats,
+                         args.preset, options, args.writer_threads)
+    if stats is not None:
+        report_stats(stats, args.stats, args.stats_json)
 
 if __name__ == "__main__":
     main()